@@ -1,27 +1,63 @@
-import smtplib
-import ssl
-from email.mime.text import MIMEText
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from datetime import datetime
+from itertools import chain
+from email.utils import format_datetime, parsedate_to_datetime
 from pathlib import Path
-from shutil import copyfileobj
+from time import time
 from typing import List
 
 import ipinfo
-from fastapi import Depends, HTTPException, UploadFile, status
+from fastapi import Depends, HTTPException, Request, Response, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 from pathlib2 import PurePosixPath
 
 import crud
-from config import ACCEPTABLE_FILE_EXTENSIONS
-from database import SessionLocal
-from schemas import InternalUser
+import imageprocessing
+from config import (ACCEPTABLE_FILE_EXTENSIONS, IMAGE_RENDITION_FORMATS,
+                    IMAGE_RENDITION_QUALITY, IMAGE_RENDITION_WIDTHS,
+                    MAIL_BATCH_SIZE, MAIL_IDLE_SECONDS, MAIL_MAX_RETRIES,
+                    MAIL_QUEUE_SIZE, MAIL_RETRY_BASE_SECONDS, MAIL_WORKERS,
+                    MAX_UPLOAD_BYTES, SMTP_HOST, SMTP_PORT, SMTP_USE_SSL,
+                    STALE_UPLOAD_SECONDS, STATIC_FILES_DIRECTORY,
+                    TOKEN_REAPER_BATCH_SIZE, TOKEN_REAPER_INTERVAL_SECONDS,
+                    UPLOAD_CHUNK_BYTES, UPLOAD_STAGING_DIRECTORY)
+from database import AsyncSessionLocal, SessionLocal
+from mailqueue import MailQueue
+from schemas import InternalUser, visibility
+from tokenreaper import TokenReaper
 
 # This is not present in the repo. It contains variables
 # EMAIL: The email the API will attempt to send from
 # PASSWORD: The password of EMAIL
 from secret_config import *
 
+# Started and stopped with the application in main.py
+mail_queue = MailQueue(
+    SMTP_HOST,
+    SMTP_PORT,
+    EMAIL,
+    PASSWORD,
+    use_ssl=SMTP_USE_SSL,
+    workers=MAIL_WORKERS,
+    batch_size=MAIL_BATCH_SIZE,
+    max_size=MAIL_QUEUE_SIZE,
+    max_retries=MAIL_MAX_RETRIES,
+    retry_base_seconds=MAIL_RETRY_BASE_SECONDS,
+    idle_seconds=MAIL_IDLE_SECONDS
+)
 
-DOMAIN = "smtp.gmail.com"
-PORT = 465
+token_reaper = TokenReaper(
+    interval_seconds=TOKEN_REAPER_INTERVAL_SECONDS,
+    batch_size=TOKEN_REAPER_BATCH_SIZE
+)
 
 # Gets database instance
 def get_db():
@@ -31,56 +67,199 @@ def get_db():
     finally:
         db.close()
 
+# Gets database instance for async endpoints. An AsyncSession when ASYNC_DATABASE_URL is configured, otherwise a
+# regular Session. Either way it must only be used through async_crud so queries never block the event loop
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+    else:
+        async with AsyncSessionLocal() as db:
+            yield db
+
+def _write_chunk(temp_file, digest, chunk: bytes):
+    digest.update(chunk)
+    temp_file.write(chunk)
+
+# Finishes a streamed upload by moving it to its content-addressed name. Returns whether the file is new
+def _commit_file(temp_file, destination: Path):
+    temp_file.close()
+    existed = destination.exists()
+    os.replace(temp_file.name, destination)
+    return not existed
+
+def _discard_file(temp_file):
+    temp_file.close()
+    if os.path.exists(temp_file.name):
+        os.remove(temp_file.name)
+
+# Removes uploads left half-written by a worker that died, from UPLOAD_STAGING_DIRECTORY and from the place
+# directories they were written to before uploads were staged. Recent ones may belong to a running worker
+def remove_stale_uploads():
+    os.makedirs(UPLOAD_STAGING_DIRECTORY, exist_ok=True)
+    cutoff = time() - STALE_UPLOAD_SECONDS
+    for path in chain(Path(UPLOAD_STAGING_DIRECTORY).glob("*.part"), Path(STATIC_FILES_DIRECTORY).glob("*/*.part")):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+# Streams an upload to disk in chunks, all file I/O happening in the threadpool. It is written to
+# UPLOAD_STAGING_DIRECTORY and only renamed into the served filePath once complete. The file is named after
+# the SHA-256 of its contents, so names never collide and identical images share one file.
+# Returns the file name and whether it was newly created
 async def write_file(filePath: Path, file: UploadFile):
-    if not filePath.exists():
-        filePath.mkdir()
+    suffix = PurePosixPath(file.filename).suffix.lower()
+    digest = hashlib.sha256()
+    size = 0
+    temp_file = await run_in_threadpool(tempfile.NamedTemporaryFile, dir=UPLOAD_STAGING_DIRECTORY, suffix=".part", delete=False)
 
-    with open(filePath / file.filename, "wb+") as file_object:
-        copyfileobj(file.file, file_object)
-    return file.filename
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File(s) exceed the size limit")
+            await run_in_threadpool(_write_chunk, temp_file, digest, chunk)
 
-async def write_files(filePath: Path, files: List[UploadFile], existing_urls: List[str]):
-    urls = list()
+        file_name = digest.hexdigest() + suffix
+        created = await run_in_threadpool(_commit_file, temp_file, filePath / file_name)
+    except BaseException:
+        await run_in_threadpool(_discard_file, temp_file)
+        raise
+    return file_name, created
 
+# Writes every file of an upload concurrently. Returns the names of the files not already in existing_urls.
+# If any file fails, the files this call created are removed again
+async def write_files(filePath: Path, files: List[UploadFile], existing_urls: List[str]):
     for file in files:
-        if PurePosixPath(file.filename).suffix not in ACCEPTABLE_FILE_EXTENSIONS:
+        if PurePosixPath(file.filename).suffix.lower() not in ACCEPTABLE_FILE_EXTENSIONS:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File(s) contain unacceptable type")
-    for file in files:
-        file_name = ''
+    await run_in_threadpool(filePath.mkdir, parents=True, exist_ok=True)
+    await run_in_threadpool(os.makedirs, UPLOAD_STAGING_DIRECTORY, exist_ok=True)
 
-        while True:
-            file_name = crud.make_random_string(10)
-            if file_name not in existing_urls:
-                break
-        file.filename = file_name + PurePosixPath(file.filename).suffix
-        urls.append(await write_file(filePath, file))
+    results = await asyncio.gather(*(write_file(filePath, file) for file in files), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        for result in results:
+            if not isinstance(result, BaseException) and result[1]:
+                await run_in_threadpool(os.remove, filePath / result[0])
+        raise errors[0]
+
+    existing_names = {PurePosixPath(url).name for url in existing_urls}
+    urls = list()
+    for file_name, _ in results:
+        if file_name not in existing_names:
+            existing_names.add(file_name)
+            urls.append(file_name)
     return urls
 
+def _record_variants(imageID: int, source: str, renditions: list):
+    db = SessionLocal()
+    try:
+        if not crud.add_thumbnail_variants(db, imageID, renditions):
+            for _, _, file_name in renditions:
+                path = os.path.join(os.path.dirname(source), file_name)
+                if os.path.exists(path):
+                    os.remove(path)
+    finally:
+        db.close()
+
+async def _process_thumbnail(imageID: int, source: str):
+    future = imageprocessing.get_pool().submit(
+        imageprocessing.make_renditions,
+        source,
+        IMAGE_RENDITION_WIDTHS,
+        IMAGE_RENDITION_FORMATS,
+        IMAGE_RENDITION_QUALITY
+    )
+    renditions = await asyncio.wrap_future(future)
+    if renditions:
+        await run_in_threadpool(_record_variants, imageID, source, renditions)
+
+# Background task run after an upload responds. Generates and records resized copies of each new thumbnail
+# in the image processing pool. A thumbnail that cannot be processed keeps being served from its original only
+async def process_thumbnails(thumbnails: list):
+    results = await asyncio.gather(*(_process_thumbnail(imageID, source) for imageID, source in thumbnails), return_exceptions=True)
+    # Failures are counted in /debug/metrics, with the latest one's error
+    for (imageID, _), result in zip(thumbnails, results):
+        imageprocessing.record_result(imageID, result if isinstance(result, Exception) else None)
+
+# Uploaded thumbnails and their variants are named after the SHA-256 of the original's contents
+CONTENT_ADDRESSED_NAME = re.compile(r"^([0-9a-f]{64})(-\d+)?\.")
+
+# Serves /usercontent. Content-addressed files never change, so they get their hash as a strong ETag and may be
+# cached forever. Anything else keeps Starlette's default validators
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        file_name = os.path.basename(full_path)
+        if CONTENT_ADDRESSED_NAME.match(file_name) is None:
+            return super().file_response(full_path, stat_result, scope, status_code)
+
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        response.headers["ETag"] = '"' + file_name.rsplit(".", 1)[0] + '"'
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+def _opaque_tag(etag: str):
+    return etag[2:] if etag.startswith("W/") else etag
+
+# Sets the ETag, Last-Modified and Cache-Control headers of a public response. Returns a 304 response to send
+# instead if the request's If-None-Match or If-Modified-Since show the client already has this version
+def check_not_modified(request: Request, response: Response, etag: str, last_modified: datetime = None):
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(), usegmt=True)
+    response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # Weak comparison, as for GET requests
+        if "*" in tags or _opaque_tag(etag) in [_opaque_tag(tag) for tag in tags]:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return None
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return None
+        if last_modified.astimezone().replace(microsecond=0) <= since:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
+
+# check_not_modified for a listing of places. The ETag is built from the count, versions and latest change of
+# every place of the visibility, so it changes whenever any of them does. prefix keeps the ETags of different
+# listings apart. There is no Last-Modified, as removing a place does not advance any remaining place's timestamp
+def check_places_not_modified(db, request: Request, response: Response, prefix: str, placeVisibility: visibility = visibility.VERIFIED):
+    count, version_sum, last_modified = crud.get_places_version(db, placeVisibility)
+    last_modified = last_modified.timestamp() if last_modified is not None else 0
+    return check_not_modified(request, response, f'W/"{prefix}-{count}-{version_sum}-{last_modified}"')
+
 def decode_token(db, token: str):
-    return crud.get_user_from_token(db, token)
+    return crud.get_user_from_account_token(db, token)
 
+# Queues the email for delivery. Raises queue.Full if the mail queue is at capacity
 def send_verification_email(user: InternalUser, token: str):
-    
-    ssl_context = ssl.create_default_context()
-    service = smtplib.SMTP_SSL(DOMAIN, PORT, context=ssl_context)
-    service.login(EMAIL, PASSWORD)
-
     msg = f"""
 Thanks for taking the first step in going on a trip to somewhere you've NeverBeen before!<br>
 Please verify your account <a href="http://neverbeen.ddns.net/index.html?token={token}">here</a><br><br>
 Thanks,
 NeverBeen."""
-    msgMIME = MIMEText(msg,'html')
-    result = service.sendmail(EMAIL, user.email, "Subject: Please verify your NeverBeen account!\n" + msgMIME.as_string())
-
-    service.quit()
-    return
+    mail_queue.enqueue(user.email, "Please verify your NeverBeen account!", msg)
 
+# Queues the email for delivery. Raises queue.Full if the mail queue is at capacity
 def send_reset_email(user: InternalUser, token: str, ip: str):
-    ssl_context = ssl.create_default_context()
-    service = smtplib.SMTP_SSL(DOMAIN, PORT, context=ssl_context)
-    service.login(EMAIL, PASSWORD)
-
     # Since Miami uses internal IPs, this information won't respond properly
     # handler = ipinfo.getHandler(IPINFO_ACCESS_TOKEN)
     # response = handler.getDetails(ip)
@@ -96,8 +275,4 @@ If this was you, please reset your account <a href="http://neverbeen.ddns.net/in
 This link is valid for 24 hours.<br><br>
 Thanks,<br>
 NeverBeen."""
-    msgMIME = MIMEText(msg,'html')
-    result = service.sendmail(EMAIL, user.email, "Subject: NeverBeen password reset!\n" + msgMIME.as_string())
-
-    service.quit()
-    return
+    mail_queue.enqueue(user.email, "NeverBeen password reset!", msg)
@@ -0,0 +1,27 @@
+from fastapi.concurrency import run_in_threadpool
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy.orm import Session
+
+import crud
+
+# Awaitable versions of every function in crud, for use from async endpoints with a session from get_async_db.
+#   place = await async_crud.get_place(db, placeID)
+# With an AsyncSession the crud function runs through run_sync, so its queries are awaited on the async driver.
+# With a regular Session it runs in the threadpool, the same way FastAPI runs plain def endpoints.
+
+
+async def run(db, function, *args, **kwargs):
+    if isinstance(db, Session):
+        return await run_in_threadpool(function, db, *args, **kwargs)
+    return await db.run_sync(function, *args, **kwargs)
+
+def __getattr__(name: str):
+    function = getattr(crud, name)
+    if not callable(function):
+        raise AttributeError(name)
+
+    async def wrapper(db, *args, **kwargs):
+        return await run(db, function, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
@@ -0,0 +1,98 @@
+import argparse
+from time import perf_counter
+
+# Installed from PIP. More information at https://numpy.org/
+import numpy
+
+from latlonhelper import distance, nearest
+
+# Taken from https://github.com/google/open-location-code
+# License information can be found in openlocationcode.py
+from openlocationcode import decode, decodeMany, encode, encodeMany
+
+# Throughput of the batch helpers against their one-at-a-time versions, on random data. Needs no database, e.g.
+#   python3 benchmarks.py plus-codes --count 1000000
+#   python3 benchmarks.py nearest --count 100000 -k 20
+
+
+def _time(function, *args):
+    started = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - started
+
+def _report(name, count, seconds, baseline=None):
+    line = f"{name:<28}{seconds:>9.3f} s{count / seconds:>14,.0f} /s"
+    if baseline is not None:
+        line += f"{baseline / seconds:>9.1f}x"
+    print(line)
+
+def plus_codes(args):
+    random = numpy.random.default_rng(args.seed)
+    for count in args.count:
+        latitudes = random.uniform(-90, 90, count)
+        longitudes = random.uniform(-180, 180, count)
+        print(f"{count:,} codes of length {args.length}")
+
+        codes, scalar = _time(lambda: [encode(latitude, longitude, args.length) for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist())])
+        _report("encode", count, scalar)
+        batch_codes, batch = _time(encodeMany, latitudes, longitudes, args.length)
+        _report("encodeMany", count, batch, scalar)
+        if batch_codes.tolist() != codes:
+            raise SystemExit("encodeMany returned different codes than encode")
+
+        centers, scalar = _time(lambda: [decode(code).latlng() for code in codes])
+        _report("decode", count, scalar)
+        (batch_latitudes, batch_longitudes), batch = _time(decodeMany, batch_codes)
+        _report("decodeMany", count, batch, scalar)
+        centers = numpy.array(centers)
+        error = max(numpy.abs(batch_latitudes - centers[:, 0]).max(), numpy.abs(batch_longitudes - centers[:, 1]).max())
+        print(f"{'largest decode difference':<28}{error:>9.1e} degrees")
+
+def nearest_places(args):
+    random = numpy.random.default_rng(args.seed)
+    latitude, longitude = 39.5, -84.7
+    for count in args.count:
+        latitudes = random.uniform(-90, 90, count)
+        longitudes = random.uniform(-180, 180, count)
+        print(f"{args.k} nearest of {count:,} places")
+
+        def scalar_nearest():
+            found = [(distance(latitude, longitude, lat, lon), index) for index, (lat, lon) in enumerate(zip(latitudes.tolist(), longitudes.tolist()))]
+            found.sort()
+            return [index for _, index in found[:args.k]]
+        expected, scalar = _time(scalar_nearest)
+        _report("distance and sort", count, scalar)
+        (indices, _), batch = _time(nearest, latitude, longitude, latitudes, longitudes, args.k)
+        _report("nearest", count, batch, scalar)
+        if indices.tolist() != expected:
+            raise SystemExit("nearest returned different places than sorting every distance")
+        if args.radius is not None:
+            _, batch = _time(nearest, latitude, longitude, latitudes, longitudes, args.k, args.radius)
+            _report(f"nearest within {args.radius:g} km", count, batch, scalar)
+
+
+# name: (function, help, [(flags, argparse options)])
+commands = {
+    "plus-codes": (plus_codes, "Compare encode and decode with encodeMany and decodeMany", [
+        (["--count"], {"type": int, "nargs": "+", "default": [100000, 1000000], "help": "number of codes, one run for each"}),
+        (["--length"], {"type": int, "default": 10, "help": "code length"}),
+        (["--seed"], {"type": int, "default": 201}),
+    ]),
+    "nearest": (nearest_places, "Compare ranking places with distance and a full sort against nearest", [
+        (["--count"], {"type": int, "nargs": "+", "default": [10000, 100000], "help": "number of places, one run for each"}),
+        (["-k"], {"type": int, "default": 20, "help": "places to return"}),
+        (["--radius"], {"type": float, "default": 500, "help": "also time nearest with this radius in kilometres"}),
+        (["--seed"], {"type": int, "default": 201}),
+    ]),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NeverBeen API benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help, arguments) in commands.items():
+        subparser = subparsers.add_parser(name, help=help)
+        for flags, options in arguments:
+            subparser.add_argument(*flags, **options)
+
+    args = parser.parse_args()
+    commands[args.command][0](args)
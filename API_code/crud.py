@@ -1,6 +1,7 @@
-import hashlib
+import base64
+import json
 import os
-import random
+import secrets
 import string
 from datetime import datetime, timedelta
 from typing import List
@@ -8,19 +9,47 @@ from typing import List
 from fastapi import HTTPException, status
 
 # Installed from PIP. More information at https://www.sqlalchemy.org/
-from sqlalchemy import desc
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, case, desc, func, or_, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, load_only, selectinload
 
+import latlonhelper
 import models
+import passwords
+import placeclusters
 import schemas
-from config import (ACCESS_TOKEN_DELTA_MINUTES, SERVER_IP,
-                    STATIC_FILES_DIRECTORY, TOKEN_LENGTH)
-from latlonhelper import distance
+import searchindex
+import signedtokens
+import spatialindex
+import tokencache
+from config import (ACCESS_TOKEN_DELTA_MINUTES, EMBEDDED_COMMENT_LIMIT,
+                    PASSRESET_TOKEN_HOURS, PLACE_CLUSTER_CELLS,
+                    SCORE_PRIOR_MEAN, SCORE_PRIOR_WEIGHT, SEARCH_RESULT_LIMIT,
+                    SERVER_IP, STATIC_FILES_DIRECTORY, TOKEN_LENGTH,
+                    TOKEN_MODE, VERIFICATION_TOKEN_HOURS)
 
 # Taken from https://github.com/google/open-location-code
 # License information can be found in openlocationcode.py
-from openlocationcode import decode, isFull
-from schemas import PatchPlace, accessLevel, tokenType, visibility
+from openlocationcode import decode, encode, isFull
+from schemas import (PatchPlace, accessLevel, placeOrder, ratingOrder, tokenType,
+                     visibility)
+
+# =============================================================================== PAGINATION
+
+# Cursors are opaque to clients: the sort key of the last row of a page, tagged with the kind of listing it
+# belongs to, as URL safe base64 JSON. The next page filters on the key instead of using OFFSET
+def encode_cursor(kind: str, *values):
+    return base64.urlsafe_b64encode(json.dumps([kind] + list(values)).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, kind: str):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or not values or values[0] != kind:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return values[1:]
 
 # =============================================================================== USERS
 
@@ -33,27 +62,60 @@ def get_user_from_username(db: Session, username: str):
 def get_user_info(db: Session, username: str):
     db_user = get_user(db, username)
     if db_user is not None:
-        return_user = schemas.InternalUser(
-                username=db_user.username,
-                email=db_user.email,
-                verified=db_user.verified,
-                images=get_thumbnails_from_user(db, db_user),
-                ratings=get_user_ratings(db, db_user),
-                places=get_places_from_user(db, db_user),
-                accessLevel=db_user.accessLevel,
-                accountCreated=db_user.accountCreated
-            )
-        return return_user
+        return build_users(db, [db_user])[0]
+
+# Builds InternalUsers with a fixed number of queries however many users there are, grouping each user's
+# images, ratings and places in Python. Leaving any of them out skips its queries and leaves the field None
+def build_users(db: Session, users: List[models.User], images: bool = True, ratings: bool = True, places: bool = True):
+    usernames = [user.username for user in users]
+    images_by_user = {username: list() for username in usernames}
+    ratings_by_user = {username: list() for username in usernames}
+    places_by_user = {username: list() for username in usernames}
+
+    if images and usernames:
+        for image in db.query(models.Thumbnail).options(selectinload(models.Thumbnail.variants)).filter(
+            models.Thumbnail.uploader.in_(usernames),
+            models.Thumbnail.verified == True
+        ).order_by(models.Thumbnail.imageID):
+            images_by_user[image.uploader].append(image)
+
+    if ratings and usernames:
+        for rating in db.query(models.Comment).filter(models.Comment.username.in_(usernames)).order_by(models.Comment.ratingID):
+            ratings_by_user[rating.username].append(rating)
+
+    if places and usernames:
+        db_places = db.query(models.Place).options(*PLACE_LOAD_OPTIONS).filter(
+            models.Place.posterID.in_(usernames)
+        ).order_by(desc(models.Place.rating)).all()
+        for db_place, place in zip(db_places, build_places(db, db_places)):
+            places_by_user[db_place.posterID].append(place)
+
+    return [schemas.InternalUser(
+        username=user.username,
+        email=user.email,
+        verified=user.verified,
+        images=images_by_user[user.username] if images else None,
+        ratings=ratings_by_user[user.username] if ratings else None,
+        places=places_by_user[user.username] if places else None,
+        accessLevel=user.accessLevel,
+        accountCreated=user.accountCreated
+    ) for user in users]
 
 def get_user_from_token(db: Session, token: str):
     return get_user(db, refresh_token_by_token(db, token).email)
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    users = db.query(models.User).offset(skip).limit(limit).all()
-    output = list()
-    for user in users:
-        output.append(get_user_info(db, user.email))
-    return output
+# Returns a page of users ordered by email and the cursor of the next page, or None if this is the last one.
+# images, ratings and places choose what is embedded in each user, as in build_users
+def get_users(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, images: bool = True, ratings: bool = True, places: bool = True):
+    query = db.query(models.User).order_by(models.User.email)
+    if cursor is not None:
+        email, = decode_cursor(cursor, "users")
+        query = query.filter(models.User.email > email)
+    users = query.offset(skip).limit(limit).all()
+    output = build_users(db, users, images, ratings, places)
+
+    next_cursor = encode_cursor("users", users[-1].email) if users and len(users) == limit else None
+    return output, next_cursor
 
 def create_user(db: Session, user: schemas.CreateUser):
     if not user.email or not user.username or not user.rawPassword:
@@ -81,8 +143,30 @@ def create_user(db: Session, user: schemas.CreateUser):
     return db_user
 
 def delete_user(db: Session, email: str):
-    db.delete(get_user(db, email=email))
+    db_user = get_user(db, email=email)
+    # Their places and comments are deleted by the database's ON DELETE CASCADE. Their places leave their cells here,
+    # and their ratings of other places are taken out of those places' totals and cells
+    places = db.query(models.Place).filter(models.Place.posterID == db_user.username).with_for_update().all()
+    for place in places:
+        if place.verified:
+            cluster_place(db, place, -1)
+    own_places = {place.placeID for place in places}
+
+    removed = dict()
+    for placeID, ratingValue in db.query(models.Comment.placeID, models.Comment.ratingValue).filter(models.Comment.username == db_user.username):
+        if placeID not in own_places:
+            removed.setdefault(placeID, list()).append(ratingValue)
+    # One UPDATE per place, decrementing its histogram and recomputing its score once
+    scores = {placeID: apply_ratings(db, placeID, [], values) for placeID, values in removed.items()}
+
+    db.delete(db_user)
     db.commit()
+    sign_out(db, email)
+    for placeID in own_places:
+        spatialindex.remove(placeID)
+        searchindex.remove(placeID)
+    for placeID, score in scores.items():
+        searchindex.set_rating(placeID, score)
 
 def set_user_perms(db: Session, email: str, accessLevel: accessLevel):
     db_user = get_user(db, email=email)
@@ -92,13 +176,20 @@ def set_user_perms(db: Session, email: str, accessLevel: accessLevel):
 
     db_user.accessLevel = accessLevel
     db.commit()
+    sign_out(db, email)
     db.refresh(db_user)
     return db_user
 
 def change_username(db: Session, user: schemas.InternalUser, username: str):
     db_user = get_user(db, user.email)
+    # Places showing the old name as poster or commenter change too
+    touch_places(db, or_(
+        models.Place.posterID == db_user.username,
+        models.Place.placeID.in_(select(models.Comment.placeID).where(models.Comment.username == db_user.username))
+    ))
     db_user.username = username
     db.commit()
+    sign_out(db, user.email)
     db.refresh(db_user)
     return db_user
 
@@ -110,151 +201,450 @@ def create_place(db: Session, place: schemas.SetPlace, user: schemas.InternalUse
     
     if not isFull(place.plusCode):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid PlusCode")
+    latitude, longitude = decode(place.plusCode).latlng()
 
     db_place = models.Place(
         posterID=user.username,
         plusCode=place.plusCode,
+        latitude=latitude,
+        longitude=longitude,
         friendlyName=place.friendlyName,
         country=place.country,
         description=place.description,
         verified=isStaff,
-        rating=-1
+        rating=-1,
+        ratingSum=0,
+        ratingCount=0,
+        score=SCORE_PRIOR_MEAN,
+        version=1,
+        lastModified=datetime.now()
     )
 
     db.add(db_place)
+    if db_place.verified:
+        add_to_clusters(db, latitude, longitude, places=1)
     db.commit()
-
+    spatialindex.upsert(db_place.placeID, latitude, longitude, db_place.verified)
+    searchindex.update(db_place.placeID, db_place.friendlyName, db_place.rating, db_place.verified)
 
     return db_place
 
+# Loads the thumbnails of every place in a result with one extra query. Comments are loaded by build_places
+PLACE_LOAD_OPTIONS = (
+    selectinload(models.Place.verifiedThumbnails).selectinload(models.Thumbnail.variants),
+)
+
+# Returns {placeID: comments} holding the newest EMBEDDED_COMMENT_LIMIT comments of each place, newest first, in a single query
+def get_embedded_comments(db: Session, placeIDs: List[int]):
+    comments = {placeID: list() for placeID in placeIDs}
+    if not placeIDs or EMBEDDED_COMMENT_LIMIT <= 0:
+        return comments
+
+    # The ratingID of each place's EMBEDDED_COMMENT_LIMIT-th newest comment, or none if it has fewer. A correlated
+    # LIMIT rather than a row_number() window, which MySQL before 8.0 and SQLite before 3.25 do not support. It is
+    # correlated to places so that it runs once per place and the comments are then read by index from the cutoff
+    cutoff = db.query(models.Comment.ratingID).filter(models.Comment.placeID == models.Place.placeID).order_by(
+        desc(models.Comment.ratingID)
+    ).offset(EMBEDDED_COMMENT_LIMIT - 1).limit(1).correlate(models.Place).scalar_subquery()
+    rows = db.query(models.Comment).select_from(models.Place).join(models.Comment, and_(
+        models.Comment.placeID == models.Place.placeID,
+        models.Comment.ratingID >= func.coalesce(cutoff, 0)
+    )).filter(models.Place.placeID.in_(placeIDs)).order_by(desc(models.Comment.ratingID)).all()
+    for row in rows:
+        comments[row.placeID].append(row)
+    return comments
+
+def build_place_stats(place: models.Place):
+    return schemas.PlaceStats(
+        count=place.ratingCount,
+        mean=place.ratingSum / place.ratingCount if place.ratingCount else None,
+        score=place.score,
+        histogram={stars: getattr(place, f"stars{stars}") for stars in range(1, 6)}
+    )
+
+def build_place(place: models.Place, comments: List[models.Comment]):
+    return schemas.InternalPlace(
+        placeID=place.placeID,
+        posterID=place.posterID,
+        plusCode=place.plusCode,
+        friendlyName=place.friendlyName,
+        country=place.country,
+        description=place.description,
+        rating=place.rating,
+        thumbnails=place.verifiedThumbnails,
+        comments=comments,
+        commentCount=place.ratingCount,
+        stats=build_place_stats(place),
+        isvisible=place.verified
+    )
+
+def build_places(db: Session, places: List[models.Place]):
+    comments = get_embedded_comments(db, [place.placeID for place in places])
+    return [build_place(place, comments[place.placeID]) for place in places]
+
 def get_place(db: Session, placeID: int, ):
-    place = db.query(models.Place).filter(models.Place.placeID == placeID).first()
+    place = db.query(models.Place).options(*PLACE_LOAD_OPTIONS).filter(models.Place.placeID == placeID).first()
 
     if place is not None:
-        returnPlace = schemas.InternalPlace(
-                placeID=place.placeID,
-                posterID=place.posterID,
-                plusCode=place.plusCode,
-                friendlyName=place.friendlyName,
-                country=place.country,
-                description=place.description,
-                rating=place.rating,
-                thumbnails=get_thumbnails_from_place(db, placeID, False),
-                comments=db.query(models.Comment).filter(models.Comment.placeID == placeID).all(),
-                isvisible=place.verified
-            )
-        return returnPlace
+        return build_places(db, [place])[0]
 
 def get_place_pointer(db: Session, placeID: int):
     return db.query(models.Place).filter(models.Place.placeID == placeID).first()
 
-def get_places_by_popularity(db: Session, skip: int = 0, limit: int = 100, visibility = visibility):
-    query = db.query(models.Place).order_by(desc('rating'))
+# Returns (version, lastModified, verified) of a place without loading it, or None
+def get_place_version(db: Session, placeID: int):
+    return db.query(models.Place).with_entities(
+        models.Place.version,
+        models.Place.lastModified,
+        models.Place.verified
+    ).filter(models.Place.placeID == placeID).first()
+
+# Returns a value that changes whenever any place with the visibility changes, is added or is removed
+def get_places_version(db: Session, visibility = visibility):
+    query = db.query(models.Place).with_entities(
+        func.count(models.Place.placeID),
+        func.coalesce(func.sum(models.Place.version), 0),
+        func.max(models.Place.lastModified)
+    )
     if visibility != visibility.ALL:
         query = query.filter(models.Place.verified == (True if visibility == 1 else False))
-    else: 
-        query = query.order_by(desc('rating'))
-    places = query.offset(skip).limit(limit).all()
-    list_of_places = list()
-    for i in places:
-        list_of_places.append(schemas.GetPlace(
-            placeID=i.placeID,
-            posterID=i.posterID,
-            plusCode=i.plusCode,
-            friendlyName=i.friendlyName,
-            country=i.country,
-            description=i.description,
-            rating=i.rating,
-            thumbnails=get_thumbnails_from_place(db, i.placeID, False),
-            comments=db.query(models.Comment).filter(models.Comment.placeID == i.placeID).all()
-        ))
-    return list_of_places
+    return query.first()
+
+# Marks places as changed so cached copies of them are revalidated. The caller commits
+def touch_places(db: Session, *criteria):
+    db.query(models.Place).filter(*criteria).update({
+        models.Place.version: models.Place.version + 1,
+        models.Place.lastModified: datetime.now()
+    }, synchronize_session=False)
 
-def get_places_by_distance(db: Session, latitude: int, longitude: int, skip: int = 0, limit: int = 100, visibility = visibility):
-    query = db.query(models.Place)
+def touch_place(db: Session, placeID: int):
+    touch_places(db, models.Place.placeID == placeID)
 
+# Returns a page of place rows ordered by score, loaded with options, and the cursor of the next page, or None if this is the last one
+def _page_by_popularity(db: Session, options: tuple, skip: int, limit: int, visibility: visibility, cursor: str):
+    query = db.query(models.Place).options(*options).order_by(desc(models.Place.score), desc(models.Place.placeID))
     if visibility != visibility.ALL:
         query = query.filter(models.Place.verified == (True if visibility == 1 else False))
-    else: 
-        query = query.order_by(desc('rating'))
+    if cursor is not None:
+        score, placeID = decode_cursor(cursor, "popularity")
+        query = query.filter(or_(
+            models.Place.score < score,
+            and_(models.Place.score == score, models.Place.placeID < placeID)
+        ))
     places = query.offset(skip).limit(limit).all()
-    places_dict_unsorted = dict()
-    places_dict_sorted = dict()
-
-    for i in places:
-        position = decode(i.plusCode).latlng()
-        placeLat = position[0]
-        placeLon = position[1]
-        dist = distance(latitude, longitude, placeLat, placeLon)
-        new_place = schemas.GetPlace(
-            placeID=i.placeID,
-            posterID=i.posterID,
-            plusCode=i.plusCode,
-            friendlyName=i.friendlyName,
-            country=i.country,
-            description=i.description,
-            rating=i.rating,
-            thumbnails=get_thumbnails_from_place(db, i.placeID, False),
-            comments=db.query(models.Comment).filter(models.Comment.placeID == i.placeID).all()
-        )
-        places_dict_unsorted[dist] = new_place
-    for i in sorted(places_dict_unsorted):
-        places_dict_sorted[i] = places_dict_unsorted[i]
-    return_list = list(places_dict_sorted.values())
-    return return_list
 
-def get_places_from_user(db: Session, user: schemas.InternalUser):
-    db_places = db.query(models.Place).order_by(desc('rating')).filter(models.Place.posterID == user.username).all()
-    return_places = list()
+    next_cursor = encode_cursor("popularity", places[-1].score, places[-1].placeID) if places and len(places) == limit else None
+    return places, next_cursor
+
+# Returns a page of place rows ordered by distance, loaded with options, and the cursor of the next page, or None if this is the last one
+def _page_by_distance(db: Session, options: tuple, latitude: float, longitude: float, skip: int, limit: int, visibility: visibility, cursor: str):
+    verified = None if visibility == visibility.ALL else visibility == visibility.VERIFIED
+    after = None
+    if cursor is not None:
+        cursor_latitude, cursor_longitude, dist, placeID = decode_cursor(cursor, "distance")
+        # The distances in a cursor only hold for the position they were measured from
+        if (cursor_latitude, cursor_longitude) != (latitude, longitude):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor was made for another position")
+        after = (dist, placeID)
+
+    nearest = spatialindex.nearest(db, latitude, longitude, skip + limit, verified, after)[skip:]
+    if not nearest:
+        return list(), None
+    placeIDs = [placeID for placeID, _ in nearest]
+
+    places = db.query(models.Place).options(*options).filter(models.Place.placeID.in_(placeIDs)).all()
+    places_by_id = {i.placeID: i for i in places}
+
+    next_cursor = encode_cursor("distance", latitude, longitude, nearest[-1][1], nearest[-1][0]) if len(nearest) == limit else None
+    return [places_by_id[placeID] for placeID in placeIDs if placeID in places_by_id], next_cursor
+
+# Returns a page of places ordered by score and the cursor of the next page, or None if this is the last one
+def get_places_by_popularity(db: Session, skip: int = 0, limit: int = 100, visibility = visibility, cursor: str = None):
+    places, next_cursor = _page_by_popularity(db, PLACE_LOAD_OPTIONS, skip, limit, visibility, cursor)
+    return build_places(db, places), next_cursor
+
+# Returns a page of places ordered by distance and the cursor of the next page, or None if this is the last one
+def get_places_by_distance(db: Session, latitude: float, longitude: float, skip: int = 0, limit: int = 100, visibility = visibility, cursor: str = None):
+    places, next_cursor = _page_by_distance(db, PLACE_LOAD_OPTIONS, latitude, longitude, skip, limit, visibility, cursor)
+    return build_places(db, places), next_cursor
+
+# Only the columns a summary shows. Thumbnails and comments are never loaded
+PLACE_SUMMARY_LOAD_OPTIONS = (
+    load_only(models.Place.placeID, models.Place.friendlyName, models.Place.plusCode, models.Place.rating, models.Place.score),
+)
+
+# Returns {placeID: externalURL} of the first verified thumbnail of each place, in a single query
+def get_cover_images(db: Session, placeIDs: List[int]):
+    if not placeIDs:
+        return dict()
+    first_images = db.query(func.min(models.Thumbnail.imageID)).filter(
+        models.Thumbnail.placeID.in_(placeIDs),
+        models.Thumbnail.verified == True
+    ).group_by(models.Thumbnail.placeID)
+    rows = db.query(models.Thumbnail).with_entities(
+        models.Thumbnail.placeID,
+        models.Thumbnail.externalURL
+    ).filter(models.Thumbnail.imageID.in_(first_images)).all()
+    return {row.placeID: row.externalURL for row in rows}
+
+def build_place_summaries(db: Session, places: List[models.Place]):
+    covers = get_cover_images(db, [place.placeID for place in places])
+    return [schemas.PlaceSummary(
+        placeID=place.placeID,
+        friendlyName=place.friendlyName,
+        plusCode=place.plusCode,
+        rating=place.rating,
+        coverImage=covers.get(place.placeID)
+    ) for place in places]
+
+# Same pages as get_places_by_popularity and get_places_by_distance, with the same cursors, as summaries
+def get_place_summaries(db: Session, order: placeOrder, latitude: float = 0, longitude: float = 0, skip: int = 0, limit: int = 100, visibility = visibility, cursor: str = None):
+    if order == placeOrder.POPULARITY:
+        places, next_cursor = _page_by_popularity(db, PLACE_SUMMARY_LOAD_OPTIONS, skip, limit, visibility, cursor)
+    else:
+        places, next_cursor = _page_by_distance(db, PLACE_SUMMARY_LOAD_OPTIONS, latitude, longitude, skip, limit, visibility, cursor)
+    return build_place_summaries(db, places), next_cursor
+
+# Summary columns and the position, for map markers
+PLACE_MARKER_LOAD_OPTIONS = (
+    load_only(models.Place.placeID, models.Place.friendlyName, models.Place.plusCode, models.Place.rating, models.Place.latitude, models.Place.longitude),
+)
 
-    for i in db_places:
-        return_places.append(get_place(db, i.placeID))
-    return return_places
+# Plus code prefix lengths places are clustered by, and the size in degrees of their cells
+CLUSTER_LEVELS = {8: 0.0025, 6: 0.05, 4: 1.0, 2: 20.0}
 
-def get_place_names(db: Session, name: str):
-    db_places = db.query(models.Place).order_by(desc('rating')).filter(models.Place.friendlyName.contains(name)).filter(models.Place.verified == 1).all()
-    return_places = list()
+def build_place_markers(db: Session, places: List[models.Place], distances: dict = None):
+    covers = get_cover_images(db, [place.placeID for place in places])
+    return [schemas.PlaceMarker(
+        placeID=place.placeID,
+        friendlyName=place.friendlyName,
+        plusCode=place.plusCode,
+        rating=place.rating,
+        coverImage=covers.get(place.placeID),
+        latitude=place.latitude,
+        longitude=place.longitude,
+        distance=distances.get(place.placeID) if distances is not None else None
+    ) for place in places]
+
+# Filters places to a box. The box crosses the antimeridian when west is greater than east
+def _in_area(query, south: float, west: float, north: float, east: float, visibility: visibility):
+    query = query.filter(models.Place.latitude >= south, models.Place.latitude <= north)
+    if west <= east:
+        query = query.filter(models.Place.longitude >= west, models.Place.longitude <= east)
+    else:
+        query = query.filter(or_(models.Place.longitude >= west, models.Place.longitude <= east))
+    if visibility != visibility.ALL:
+        query = query.filter(models.Place.verified == (True if visibility == 1 else False))
+    return query
+
+# Smallest plus code cells that split the box into at most PLACE_CLUSTER_CELLS across its longer side
+def cluster_level(south: float, west: float, north: float, east: float):
+    span = max(north - south, east - west if west <= east else east - west + 360)
+    for level, size in CLUSTER_LEVELS.items():
+        if span / size <= PLACE_CLUSTER_CELLS:
+            return level
+    return min(CLUSTER_LEVELS)
+
+# Number of cells of a level that a box spans, counting partly covered ones
+def cells_in_area(level: int, south: float, west: float, north: float, east: float):
+    size = CLUSTER_LEVELS[level]
+    width = east - west if west <= east else east - west + 360
+    return (int((north - south) / size) + 1) * (int(width / size) + 1)
+
+# Returns the verified places inside a box, highest scored first, or if there are more than limit, the cells overlapping the box
+# as in get_place_clusters. Clusters always count verified places, whatever the visibility
+def get_places_within(db: Session, south: float, west: float, north: float, east: float, limit: int = 100, visibility = visibility):
+    spatialindex.ensure_loaded(db)
+    total = _in_area(db.query(func.count(models.Place.placeID)), south, west, north, east, visibility).scalar()
+    if total <= limit:
+        places = _in_area(db.query(models.Place), south, west, north, east, visibility).options(*PLACE_MARKER_LOAD_OPTIONS).order_by(desc(models.Place.score), desc(models.Place.placeID)).all()
+        return schemas.PlacesInArea(total=total, places=build_place_markers(db, places))
+
+    level = cluster_level(south, west, north, east)
+    return schemas.PlacesInArea(total=total, clusters=get_place_clusters(db, level, south, west, north, east))
+
+# Returns the limit places closest to a position within radius kilometres, nearest first, and how many are within it.
+# Candidates are read from the position index inside the radius' bounding box and ranked by latlonhelper.nearest
+def get_places_near(db: Session, latitude: float, longitude: float, radius: float, limit: int = 100, visibility = visibility):
+    spatialindex.ensure_loaded(db)
+    south, north, west, east = latlonhelper.bounding_box(latitude, longitude, radius)
+    candidates = _in_area(db.query(models.Place).with_entities(
+        models.Place.placeID,
+        models.Place.latitude,
+        models.Place.longitude
+    ), south, west, north, east, visibility).all()
+    # Ordered by ID, so places at the same distance are too
+    candidates.sort(key=lambda row: row.placeID)
+    latitudes = [row.latitude for row in candidates]
+    longitudes = [row.longitude for row in candidates]
+
+    total = int((latlonhelper.distances(latitude, longitude, latitudes, longitudes) <= radius).sum()) if candidates else 0
+    indices, found = latlonhelper.nearest(latitude, longitude, latitudes, longitudes, limit, radius)
+    distances = {candidates[index].placeID: float(distance) for index, distance in zip(indices, found)}
+
+    places = db.query(models.Place).options(*PLACE_MARKER_LOAD_OPTIONS).filter(models.Place.placeID.in_(list(distances))).all() if distances else list()
+    places.sort(key=lambda place: (distances[place.placeID], place.placeID))
+    return schemas.PlacesInArea(total=total, places=build_place_markers(db, places, distances))
+
+# =============================================================================== PLACE CLUSTERS
+
+# Columns of models.PlaceCluster that are running totals
+CLUSTER_TOTALS = ("placeCount", "ratingSum", "ratingCount", "latitudeSum", "longitudeSum")
+
+# Returns the verified place totals of every cell overlapping a box at a level of CLUSTER_LEVELS, ordered by cell. Cells are read
+# from place_clusters through its index, so this costs the same however many places they hold. A cell's totals include
+# its places outside the box
+def get_place_clusters(db: Session, level: int, south: float, west: float, north: float, east: float):
+    size = CLUSTER_LEVELS[level]
+    cluster = models.PlaceCluster
+    query = db.query(cluster).filter(
+        cluster.level == level,
+        cluster.south > south - size,
+        cluster.south <= north,
+        cluster.placeCount > 0
+    )
+    if west <= east:
+        query = query.filter(cluster.west > west - size, cluster.west <= east)
+    else:
+        query = query.filter(or_(cluster.west > west - size, cluster.west <= east))
+
+    padding = "0" * (8 - level) + "+"
+    return [schemas.PlaceCluster(
+        cell=row.cell + padding,
+        count=row.placeCount,
+        latitude=row.latitudeSum / row.placeCount,
+        longitude=row.longitudeSum / row.placeCount,
+        rating=round(row.ratingSum / row.ratingCount, 1) if row.ratingCount > 0 else -1
+    ) for row in query.order_by(cluster.cell).all()]
+
+# Adds changes to the totals of the cell holding a position, at every level. places is the number of verified places
+# added there, negative when removed, and ratingSum and ratingCount the change to their comments' totals. Every cell
+# is upserted with its totals incremented in the one statement, so concurrent writes never lose updates. The caller
+# commits, keeping the cells in the same transaction as the place or rating
+def add_to_clusters(db: Session, latitude: float, longitude: float, places: int = 0, ratingSum: int = 0, ratingCount: int = 0):
+    rows = list()
+    for level in CLUSTER_LEVELS:
+        code = encode(latitude, longitude, level)
+        area = decode(code)
+        rows.append(dict(
+            level=level,
+            cell=code[:level],
+            south=area.latitudeLo,
+            west=area.longitudeLo,
+            placeCount=places,
+            ratingSum=ratingSum,
+            ratingCount=ratingCount,
+            latitudeSum=places * latitude,
+            longitudeSum=places * longitude
+        ))
 
-    for i in db_places:
-        new_place = schemas.SearchPlace(
-            placeID=i.placeID,
-            friendlyName=i.friendlyName
+    table = models.PlaceCluster.__table__
+    if db.get_bind().dialect.name == "mysql":
+        statement = mysql.insert(table).values(rows)
+        statement = statement.on_duplicate_key_update({name: table.c[name] + statement.inserted[name] for name in CLUSTER_TOTALS})
+    else:
+        statement = sqlite.insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.level, table.c.cell],
+            set_={name: table.c[name] + statement.excluded[name] for name in CLUSTER_TOTALS}
         )
-        return_places.append(new_place)
-    return return_places
+    db.execute(statement)
+
+# Position of a place, decoded from its plus code if it was stored before places had coordinates
+def place_position(place: models.Place):
+    if place.latitude is None:
+        return decode(place.plusCode).latlng()
+    return place.latitude, place.longitude
+
+# Adds a verified place and its ratings to its cells, or with sign -1 removes them. The caller commits
+def cluster_place(db: Session, place: models.Place, sign: int = 1):
+    latitude, longitude = place_position(place)
+    add_to_clusters(db, latitude, longitude, places=sign, ratingSum=sign * place.ratingSum, ratingCount=sign * place.ratingCount)
+
+# Recomputes place_clusters from every verified place. crud keeps the cells up to date on every write, including a
+# user's deletion, so this is only needed to recover from changes made to the database by hand. Returns the number of cells
+def rebuild_place_clusters(db: Session):
+    places = db.query(models.Place).with_entities(
+        models.Place.plusCode,
+        models.Place.latitude,
+        models.Place.longitude,
+        models.Place.ratingSum,
+        models.Place.ratingCount
+    ).filter(models.Place.verified == True).all()
+
+    db.query(models.PlaceCluster).delete(synchronize_session=False)
+    rows = placeclusters.cluster_rows(places, CLUSTER_LEVELS)
+    if rows:
+        db.execute(models.PlaceCluster.__table__.insert(), rows)
+    db.commit()
+    return len(rows)
+
+def get_places_from_user(db: Session, user: schemas.InternalUser):
+    db_places = db.query(models.Place).options(*PLACE_LOAD_OPTIONS).order_by(desc('rating')).filter(models.Place.posterID == user.username).all()
+    return build_places(db, db_places)
+
+def get_place_names(db: Session, name: str, limit: int = SEARCH_RESULT_LIMIT):
+    return [
+        schemas.SearchPlace(placeID=placeID, friendlyName=friendlyName)
+        for placeID, friendlyName in searchindex.search(db, name, limit)
+    ]
 
 def update_place(db: Session, place: PatchPlace):
-    db_place = db.query(models.Place).filter(models.Place.placeID == place.placeID).first()
+    # Locked, so its rating totals cannot change before they are moved between cells
+    db_place = db.query(models.Place).filter(models.Place.placeID == place.placeID).with_for_update().first()
+    if place.plusCode != db_place.plusCode or db_place.latitude is None:
+        if db_place.verified:
+            cluster_place(db, db_place, -1)
+        db_place.latitude, db_place.longitude = decode(place.plusCode).latlng()
+        if db_place.verified:
+            add_to_clusters(db, db_place.latitude, db_place.longitude, places=1, ratingSum=db_place.ratingSum, ratingCount=db_place.ratingCount)
     db_place.plusCode = place.plusCode
     db_place.friendlyName = place.friendlyName
     db_place.country = place.country
     db_place.description = place.description
+    db_place.version = models.Place.version + 1
+    db_place.lastModified = datetime.now()
 
     db.commit()
+    spatialindex.upsert(db_place.placeID, db_place.latitude, db_place.longitude, db_place.verified)
+    searchindex.update(db_place.placeID, db_place.friendlyName, db_place.rating, db_place.verified)
     return get_place(db, db_place.placeID)
 
 def set_place_visibility(db: Session, placeID: int, visibility: bool):
-    place = db.query(models.Place).filter(models.Place.placeID == placeID).first()
+    place = db.query(models.Place).filter(models.Place.placeID == placeID).with_for_update().first()
+    if place.verified != visibility:
+        cluster_place(db, place, 1 if visibility else -1)
     place.verified = visibility
+    place.version = models.Place.version + 1
+    place.lastModified = datetime.now()
     db.commit()
+    spatialindex.set_verified(placeID, visibility)
+    searchindex.update(placeID, place.friendlyName, place.rating, visibility)
 
 def delete_place(db: Session, placeID: int):
-    thumbnails = get_thumbnails_from_place(db, placeID)
+    thumbnails = get_thumbnails_from_place(db, placeID, True)
     for thumbnail in thumbnails:
-        os.remove(thumbnail.internalURL)
-    db.delete(get_place_pointer(db, placeID=placeID))
+        remove_thumbnail_files(thumbnail)
+    place = db.query(models.Place).filter(models.Place.placeID == placeID).with_for_update().first()
+    if place.verified:
+        cluster_place(db, place, -1)
+    db.delete(place)
     db.commit()
+    spatialindex.remove(placeID)
+    searchindex.remove(placeID)
 
 
 # =============================================================================== THUMBNAILS
 
+# Returns (imageID, internalURL) of every thumbnail added, for image processing
 def add_thumbnail_urls(db: Session, urls: List[str], placeID: int, uploader: schemas.InternalUser):
     place = db.query(models.Place).filter(models.Place.placeID == placeID).first()
 
     isverified = uploader.accessLevel != accessLevel.USER
     if place is None:
-        return
+        return list()
 
+    db_thumbnails = list()
     for image in urls:
         db_thumbnail = models.Thumbnail(
             uploader=uploader.username,
@@ -265,10 +655,34 @@ def add_thumbnail_urls(db: Session, urls: List[str], placeID: int, uploader: sch
             uploadDate=datetime.now()
         )
         db.add(db_thumbnail)
+        db_thumbnails.append(db_thumbnail)
+    db.flush()
+    added = [(i.imageID, i.internalURL) for i in db_thumbnails]
+    touch_place(db, placeID)
     db.commit()
-    db.refresh(place)
 
-    return get_place(db, placeID)
+    return added
+
+# Records the resized copies generated for a thumbnail. renditions are (width, format, file name) tuples
+# of files stored next to the original. Returns False if the thumbnail was deleted in the meantime
+def add_thumbnail_variants(db: Session, imageID: int, renditions: list):
+    thumbnail = get_thumbnail(db, imageID)
+    if thumbnail is None:
+        return False
+
+    internal_directory = thumbnail.internalURL.rsplit("/", 1)[0] + "/"
+    external_directory = thumbnail.externalURL.rsplit("/", 1)[0] + "/"
+    for width, format, file_name in renditions:
+        db.add(models.ThumbnailVariant(
+            imageID=imageID,
+            width=width,
+            format=format,
+            internalURL=internal_directory + file_name,
+            externalURL=external_directory + file_name
+        ))
+    touch_place(db, thumbnail.placeID)
+    db.commit()
+    return True
 
 def get_thumbnail_urls(db: Session, placeID: int):
     result = list()
@@ -285,7 +699,7 @@ def get_thumbnails_from_place(db: Session, placeID: int, show_unverified: bool):
     return query.all()
 
 def get_thumbnails_from_user(db: Session, user: schemas.InternalUser):
-    return db.query(models.Thumbnail).filter(models.Thumbnail.uploader == user.username).filter(models.Thumbnail.verified == True).all()
+    return db.query(models.Thumbnail).options(selectinload(models.Thumbnail.variants)).filter(models.Thumbnail.uploader == user.username).filter(models.Thumbnail.verified == True).all()
 
 def get_thumbnail(db: Session, imageID: int):
     return db.query(models.Thumbnail).filter(models.Thumbnail.imageID == imageID).first()
@@ -293,22 +707,36 @@ def get_thumbnail(db: Session, imageID: int):
 def set_thumbnail_visibility(db: Session, imageID: int, visibility: bool):
     image = db.query(models.Thumbnail).filter(models.Thumbnail.imageID == imageID).first()
     image.verified = visibility
+    touch_place(db, image.placeID)
     db.commit()
 
-def get_unverified_thumbnails(db: Session, skip: int = 0, limit: int = 100):
-    query = db.query(models.Thumbnail)
-    images = query.filter(models.Thumbnail.verified == False).offset(skip).limit(limit).all()
-    return images
+# Returns a page of unverified thumbnails, oldest first, and the cursor of the next page, or None if this is the last one
+def get_unverified_thumbnails(db: Session, skip: int = 0, limit: int = 100, cursor: str = None):
+    query = db.query(models.Thumbnail).options(selectinload(models.Thumbnail.variants)).order_by(models.Thumbnail.imageID)
+    query = query.filter(models.Thumbnail.verified == False)
+    if cursor is not None:
+        imageID, = decode_cursor(cursor, "images")
+        query = query.filter(models.Thumbnail.imageID > imageID)
+    images = query.offset(skip).limit(limit).all()
+
+    next_cursor = encode_cursor("images", images[-1].imageID) if images and len(images) == limit else None
+    return images, next_cursor
+
+def remove_thumbnail_files(thumbnail: models.Thumbnail):
+    for path in [thumbnail.internalURL] + [variant.internalURL for variant in thumbnail.variants]:
+        if os.path.exists(path):
+            os.remove(path)
 
 def delete_thumbnail(db: Session, imageID: int):
     image = get_thumbnail(db, imageID)
-    os.remove(image.internalURL)
+    remove_thumbnail_files(image)
 
     path = STATIC_FILES_DIRECTORY + str(image.placeID)
 
     if not any(os.scandir(path)):
         os.rmdir(path)
-    db.delete(get_thumbnail(db, imageID))
+    touch_place(db, image.placeID)
+    db.delete(image)
     db.commit()
 
 # =============================================================================== COMMENTS
@@ -325,18 +753,28 @@ def create_rating(db: Session, rating: schemas.SetRating, user: schemas.Internal
     )
 
     db.add(db_rating)
+    db.flush()
+    score = update_score(db, rating.placeID, added=rating.ratingValue)
     db.commit()
-    update_score(db, rating.placeID)
+    searchindex.set_rating(rating.placeID, score)
 
     return db_rating
 
 def update_rating(db: Session, rating: schemas.GetRating):
-    db_rating = db.query(models.Comment).filter(models.Comment.placeID == rating.placeID).first()
+    db_rating = db.query(models.Comment).filter(models.Comment.ratingID == rating.ratingID).first()
+    old_value = db_rating.ratingValue
     db_rating.commentBody = rating.commentBody
     db_rating.ratingValue = rating.ratingValue
     db_rating.timeEdited = datetime.now()
 
-    db.commit()
+    db.flush()
+    if rating.ratingValue != old_value:
+        score = update_score(db, db_rating.placeID, added=rating.ratingValue, removed=old_value)
+        db.commit()
+        searchindex.set_rating(db_rating.placeID, score)
+    else:
+        touch_place(db, db_rating.placeID)
+        db.commit()
     return db_rating
 
 def get_rating(db: Session, ratingID: int):
@@ -354,6 +792,40 @@ def get_rating(db: Session, ratingID: int):
             )
         return return_rating
 
+# Returns a page of a place's ratings in the given order and the cursor of the next page, or None if this is the last one.
+# Ties between equal ratings are broken by ratingID so that pages never overlap
+def get_place_ratings(db: Session, placeID: int, order: ratingOrder = ratingOrder.NEWEST, limit: int = 20, cursor: str = None):
+    comment = models.Comment
+    query = db.query(comment).filter(comment.placeID == placeID)
+    kind = f"ratings-{order.value}"
+    if cursor is not None:
+        cursor_placeID, ratingValue, ratingID = decode_cursor(cursor, kind)
+        if cursor_placeID != placeID:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor was made for another place")
+
+    if order == ratingOrder.NEWEST:
+        query = query.order_by(desc(comment.ratingID))
+        if cursor is not None:
+            query = query.filter(comment.ratingID < ratingID)
+    elif order == ratingOrder.HIGHEST:
+        query = query.order_by(desc(comment.ratingValue), desc(comment.ratingID))
+        if cursor is not None:
+            query = query.filter(or_(
+                comment.ratingValue < ratingValue,
+                and_(comment.ratingValue == ratingValue, comment.ratingID < ratingID)
+            ))
+    else:
+        query = query.order_by(comment.ratingValue, comment.ratingID)
+        if cursor is not None:
+            query = query.filter(or_(
+                comment.ratingValue > ratingValue,
+                and_(comment.ratingValue == ratingValue, comment.ratingID > ratingID)
+            ))
+    ratings = query.limit(limit).all()
+
+    next_cursor = encode_cursor(kind, placeID, ratings[-1].ratingValue, ratings[-1].ratingID) if ratings and len(ratings) == limit else None
+    return ratings, next_cursor
+
 def get_rating_pointer(db: Session, ratingID = int):
     return db.query(models.Comment).filter(models.Comment.ratingID == ratingID).first()
 
@@ -363,34 +835,95 @@ def get_user_ratings(db: Session, user: schemas.InternalUser):
 def delete_rating(db: Session, ratingID: int):
     rating = get_rating_pointer(db, ratingID)
     placeID = rating.placeID
+    ratingValue = rating.ratingValue
     db.delete(rating)
+    db.flush()
+    score = update_score(db, placeID, removed=ratingValue)
     db.commit()
-    update_score(db, placeID)
-
-def update_score(db: Session, placeID: int):
-    ratings = db.query(models.Comment).filter(models.Comment.placeID == placeID).all()
-    
-    ratingValues = list()
-    for i in ratings:
-        ratingValues.append(i.ratingValue)
-
-    sum = 0
-    for i in ratingValues:
-        sum += i
-
-    place = db.query(models.Place).filter(models.Place.placeID == placeID).first()
-    if len(ratingValues) == 0:
-        place.rating = -1
-    else:
-        place.rating = round((sum / (len(ratingValues))), 1)
-    db.commit()
+    searchindex.set_rating(placeID, score)
+
+# Average rating rounded to one decimal, or -1 when the place has no ratings
+RATING_EXPRESSION = case(
+    (models.Place.ratingCount == 0, -1),
+    else_=func.round(models.Place.ratingSum * 1.0 / models.Place.ratingCount, 1)
+)
+
+# Bayesian average: the place's ratings plus SCORE_PRIOR_WEIGHT imaginary ratings of SCORE_PRIOR_MEAN stars,
+# so a handful of ratings cannot outrank a long record of good ones
+SCORE_EXPRESSION = (SCORE_PRIOR_WEIGHT * SCORE_PRIOR_MEAN + models.Place.ratingSum) * 1.0 / (SCORE_PRIOR_WEIGHT + models.Place.ratingCount)
+
+def star_column(ratingValue: int):
+    return getattr(models.Place, f"stars{ratingValue}")
+
+# Applies a rating being added, removed or changed from one value to another to a place's running totals in SQL,
+# and to its cells if it is verified, so concurrent writes never lose updates. The caller commits, keeping the
+# totals in the same transaction as the rating itself. Returns the new rating
+def update_score(db: Session, placeID: int, added: int = None, removed: int = None):
+    return apply_ratings(db, placeID, [added] if added is not None else [], [removed] if removed is not None else [])
+
+# Same as update_score for any number of ratings added and removed at once, in a single UPDATE of the totals and
+# histogram, so the rating and score are recomputed once
+def apply_ratings(db: Session, placeID: int, added: List[int], removed: List[int]):
+    ratingSum = sum(added) - sum(removed)
+    ratingCount = len(added) - len(removed)
+    totals = {
+        models.Place.ratingSum: models.Place.ratingSum + ratingSum,
+        models.Place.ratingCount: models.Place.ratingCount + ratingCount,
+        models.Place.version: models.Place.version + 1,
+        models.Place.lastModified: datetime.now()
+    }
+    for stars in set(added) | set(removed):
+        change = added.count(stars) - removed.count(stars)
+        if change != 0:
+            totals[star_column(stars)] = star_column(stars) + change
+
+    query = db.query(models.Place).filter(models.Place.placeID == placeID)
+    query.update(totals, synchronize_session=False)
+    query.update({models.Place.rating: RATING_EXPRESSION, models.Place.score: SCORE_EXPRESSION}, synchronize_session=False)
+    place = query.with_entities(
+        models.Place.rating,
+        models.Place.verified,
+        models.Place.plusCode,
+        models.Place.latitude,
+        models.Place.longitude
+    ).one()
+    if place.verified:
+        latitude, longitude = place_position(place)
+        add_to_clusters(db, latitude, longitude, ratingSum=ratingSum, ratingCount=ratingCount)
+    return place.rating
+
+# Recomputes every place's rating totals, histogram and scores from its comments in bulk, and the place_clusters
+# built from them. Also run it after changing the score prior in config.py. Returns the number of places updated
+def repair_scores(db: Session):
+    place_comments = models.Comment.placeID == models.Place.placeID
+    totals = {
+        models.Place.ratingSum: select(func.coalesce(func.sum(models.Comment.ratingValue), 0)).where(place_comments).scalar_subquery(),
+        models.Place.ratingCount: select(func.count(models.Comment.ratingID)).where(place_comments).scalar_subquery()
+    }
+    for stars in range(1, 6):
+        totals[star_column(stars)] = select(func.count(models.Comment.ratingID)).where(
+            place_comments,
+            models.Comment.ratingValue == stars
+        ).scalar_subquery()
+
+    updated = db.query(models.Place).update(totals, synchronize_session=False)
+    db.query(models.Place).update({models.Place.rating: RATING_EXPRESSION, models.Place.score: SCORE_EXPRESSION}, synchronize_session=False)
+    # Commits the totals together with the cells recomputed from them
+    rebuild_place_clusters(db)
+    return updated
 
 
 # =============================================================================== SECURITY
 
 
+# Salted, slow hash in the format described in passwords.py. Async code should use passwords.hash_async instead
 def hash_password(password: str):
-    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+    return passwords.hash_password(password)
+
+# Stores a hash made by hash_password, e.g. when a legacy hash is upgraded on login
+def set_password_hash(db: Session, email: str, hashed_password: str):
+    db.query(models.User).filter(models.User.email == email).update({models.User.hashed_password: hashed_password}, synchronize_session=False)
+    db.commit()
 
 def get_token_by_user(db: Session, email: str, type: models.tokenType):
     return db.query(models.Token).filter(models.Token.email == email).filter(models.Token.type == type).first()
@@ -401,57 +934,109 @@ def get_token_by_token(db: Session, token: str):
 def delete_token(db: Session, email: str, type:models.tokenType):
     db.delete(get_token_by_user(db, email, type))
     db.commit()
+    tokencache.invalidate_user(email)
 
 def make_random_string(length: int):
-    return ''.join(random.choice(string.ascii_letters + string.digits) for x in range(length))
+    return ''.join(secrets.choice(string.ascii_letters + string.digits) for x in range(length))
 
-def create_token(db: Session, email: str, type: models.tokenType):
-    token = ''
+# Ends every session of a user. Signed tokens carry the user's name and access level, so they are also
+# revoked whenever those change
+def sign_out(db: Session, email: str):
+    db.query(models.Token).filter(models.Token.email == email, models.Token.type == tokenType.ACCOUNT).delete(synchronize_session=False)
+    db.commit()
+    tokencache.invalidate_user(email)
+    if TOKEN_MODE == "signed":
+        signedtokens.revoke(db, email)
 
-    # If user token already exists, delete and continue
-    if get_token_by_user(db, email, type) is not None:
-        delete_token(db, email, type)
+# Random tokens tried before create_token gives up. A collision of 64 random characters is practically impossible,
+# so running out means something else is wrong
+TOKEN_CREATE_ATTEMPTS = 5
 
+# Replaces the user's token of a type with a new one and returns it
+def create_token(db: Session, email: str, type: models.tokenType):
     # If user does not exist, throw error
-    if get_user(db, email) is None:
+    db_user = get_user(db, email)
+    if db_user is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found")
 
-    db_token = models.Token(
-        email=email,
-        type=type,
-        token=token
-    )
+    # Signed ACCOUNT tokens are not stored
+    if type == tokenType.ACCOUNT and TOKEN_MODE == "signed":
+        tokencache.invalidate_user(email)
+        return signedtokens.issue(db_user)
 
     if type == tokenType.ACCOUNT:
-        db_token.expires = datetime.now() + timedelta(minutes=ACCESS_TOKEN_DELTA_MINUTES)
-    if type == tokenType.PASSRESET:
-        db_token.expires = datetime.now() + timedelta(days=1)
-    if type == tokenType.VERIFICATION:
-        # This value isn't used as verification tokens don't check if expired.
-        db_token.expires = datetime.now()
-
-    # Makes sure that it never uses the same token more than once in the DB.
-    while True:
-        db_token.token = make_random_string(TOKEN_LENGTH)
+        expires = datetime.now() + timedelta(minutes=ACCESS_TOKEN_DELTA_MINUTES)
+    elif type == tokenType.PASSRESET:
+        expires = datetime.now() + timedelta(hours=PASSRESET_TOKEN_HOURS)
+    else:
+        expires = datetime.now() + timedelta(hours=VERIFICATION_TOKEN_HOURS)
+
+    raced = False
+    for attempt in range(TOKEN_CREATE_ATTEMPTS):
+        token = make_random_string(TOKEN_LENGTH)
+        # The existing token is deleted in the same transaction, so the (email, type) key is free for the new one
+        db.query(models.Token).filter(models.Token.email == email, models.Token.type == type).delete(synchronize_session=False)
+        db.add(models.Token(email=email, type=type, token=token, expires=expires))
         try:
-            db.add(db_token)
             db.commit()
-            return db_token.token
-        except:
-            pass
-
+        except IntegrityError:
+            db.rollback()
+            # Makes sure that it never uses the same token more than once in the DB
+            if get_token_by_token(db, token) is not None:
+                continue
+            # Otherwise a concurrent request, such as a second login, inserted a token for (email, type) after the
+            # delete. The next attempt deletes and replaces it. If that conflicts again, the error is not a race
+            if raced:
+                raise
+            raced = True
+            continue
+        tokencache.invalidate_user(email)
+        return token
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Could not create a token")
+
+# Only ACCOUNT tokens slide. PASSRESET and VERIFICATION tokens keep the expiry they were issued with
 def refresh_token_by_token(db: Session, token: str):
     db_token = get_token_by_token(db, token)
     if db_token is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad token")
 
-    if db_token.expires < datetime.now() and db_token.type == tokenType.ACCOUNT:
+    if db_token.expires < datetime.now():
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Token expired")
-    else:
+    elif db_token.type == tokenType.ACCOUNT:
         db_token.expires = datetime.now() + timedelta(minutes=ACCESS_TOKEN_DELTA_MINUTES)
         db.commit()
     return db_token
 
+# Resolves the user behind a token for an authenticated request. ACCOUNT tokens are served from
+# tokencache, which only checks the token row on a hit and never writes; their sliding expiry
+# is flushed in batches. Signed tokens are checked from their signature alone, see signedtokens.py.
+# Other token types keep the refresh-on-read behaviour
+def get_user_from_account_token(db: Session, token: str):
+    if TOKEN_MODE == "signed" and signedtokens.is_signed(token):
+        return signedtokens.decode(db, token)
+
+    tokencache.flush_if_due(db)
+    user = tokencache.get(db, token)
+    if user is not None:
+        return user
+
+    db_token = get_token_by_token(db, token)
+    if db_token is None or db_token.type != tokenType.ACCOUNT:
+        return get_user_from_token(db, token)
+    if db_token.expires < datetime.now():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Token expired")
+
+    db_user = get_user(db, db_token.email)
+    user = schemas.InternalUser(
+        username=db_user.username,
+        email=db_user.email,
+        verified=db_user.verified,
+        accessLevel=db_user.accessLevel,
+        accountCreated=db_user.accountCreated
+    )
+    tokencache.put(token, user)
+    return user
+
 def refresh_token_by_user(db: Session, user: schemas.InternalUser):
     db_token = get_token_by_user(db, user.email, tokenType.ACCOUNT)
     if db_token is None:
@@ -464,14 +1049,31 @@ def refresh_token_by_user(db: Session, user: schemas.InternalUser):
         db.commit()
         return db_token
 
+# Deletes up to limit expired tokens in one transaction and returns how many were deleted. The rows are
+# picked through ix_tokens_expires and deleted by their unique token, so each batch locks only its own rows.
+# Expiry is checked again on delete in case a token was refreshed in between
+def delete_expired_tokens(db: Session, limit: int):
+    now = datetime.now()
+    expired = [row.token for row in db.query(models.Token.token).filter(models.Token.expires < now).limit(limit)]
+    if not expired:
+        return 0
+    deleted = db.query(models.Token).filter(models.Token.token.in_(expired), models.Token.expires < now).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
 def verify_account(db: Session, token: str):
     user = get_user_from_token(db, token)
     token_obj = get_token_by_token(db, token)
     user.verified = True
     db.delete(token_obj)
     db.commit()
+    tokencache.invalidate_user(user.email)
 
-def reset_password(db: Session, password: str, token: str):
+# Sets a new password, removes the user's PASSRESET token and signs them out everywhere
+# Takes the new password already hashed, so the slow hashing can happen off the event loop
+def reset_password(db: Session, hashed_password: str, token: str):
     user = get_user_from_token(db, token)
-    user.hashed_password = hash_password(password)
+    user.hashed_password = hashed_password
+    db.query(models.Token).filter(models.Token.email == user.email).filter(models.Token.type == tokenType.PASSRESET).delete(synchronize_session=False)
     db.commit()
+    sign_out(db, user.email)
@@ -3,11 +3,32 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from config import DATABASE_URL
+import pooling
+from config import ASYNC_DATABASE_URL, DATABASE_URL
 
 SQLALCHEMY_DATABASE_URL = DATABASE_URL
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
+# SQLite connections refuse to be used from a thread other than the one that opened them. The pool
+# hands them to whichever thread checks them out, and sync endpoints run in a threadpool
+def connect_args(url: str):
+    if url.startswith("sqlite"):
+        return {"check_same_thread": False}
+    return {}
+
+# Pool size, recycling and pings are set in config.py. See pooling.py
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args(SQLALCHEMY_DATABASE_URL), **pooling.engine_options())
+pooling.install_idle_ping(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Only created when ASYNC_DATABASE_URL is set, so the async driver is not required otherwise.
+# Objects stay loaded after commit because lazy loading is not possible outside of run_sync
+async_engine = None
+AsyncSessionLocal = None
+if ASYNC_DATABASE_URL is not None:
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, connect_args=connect_args(ASYNC_DATABASE_URL), **pooling.engine_options(asynchronous=True))
+    pooling.install_idle_ping(async_engine.sync_engine)
+    AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession)
+
 Base = declarative_base()
@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List
+
+# Installed from PIP. More information at https://python-pillow.org/
+from PIL import Image, ImageOps, features
+
+from config import IMAGE_PROCESS_WORKERS
+
+# Generates resized, recompressed copies of uploaded thumbnails in a pool of worker processes, keeping
+# the CPU heavy decoding and encoding away from the API's event loop and threadpool.
+
+_pool = None
+_lock = threading.Lock()
+_counters = {"processed": 0, "failed": 0}
+_last_failure = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked, as the API process already runs threads
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+# Counts a thumbnail the API finished processing, successfully unless error is given
+def record_result(imageID: int, error: Exception = None):
+    global _last_failure
+    with _lock:
+        if error is None:
+            _counters["processed"] += 1
+        else:
+            _counters["failed"] += 1
+            _last_failure = {"imageID": imageID, "error": repr(error), "time": datetime.now()}
+
+def metrics():
+    with _lock:
+        metrics = dict(_counters)
+        metrics["lastFailure"] = _last_failure
+    return metrics
+
+# Runs in a worker process. Writes "<name>-<width>.<format>" next to the source image for every width no
+# larger than the image, plus one at the image's own width if it is narrower than a requested width.
+# Orientation is applied and every other piece of metadata is dropped. Returns (width, format, file name) tuples
+def make_renditions(source: str, widths: List[int], formats: List[str], quality: int):
+    renditions = list()
+    formats = [format for format in formats if features.check(format)]
+    stem = os.path.splitext(source)[0]
+
+    with Image.open(source) as image:
+        # Resizing would drop every frame but the first
+        if getattr(image, "is_animated", False):
+            return renditions
+
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.mode in ("LA", "P", "PA") else "RGB")
+
+        for width in sorted({min(width, image.width) for width in widths}):
+            if width == image.width:
+                resized = image
+            else:
+                resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+            for format in formats:
+                path = f"{stem}-{width}.{format}"
+                resized.save(path, format=format.upper(), quality=quality)
+                renditions.append((width, format, os.path.basename(path)))
+    return renditions
@@ -1,8 +1,74 @@
-from math import asin, cos, pi, sqrt
+from math import asin, cos, degrees, pi, sin, sqrt
+
+# Installed from PIP. More information at https://numpy.org/
+import numpy
+
+EARTH_DIAMETER_KM = 12742
 
 # Taken from https://stackoverflow.com/questions/27928/calculate-distance-between-two-latitude-longitude-points-haversine-formula
 
 def distance(lat1, lon1, lat2, lon2):
     p = pi/180
     a = 0.5 - cos((lat2-lat1)*p)/2 + cos(lat1*p) * cos(lat2*p) * (1-cos((lon2-lon1)*p))/2
-    return 12742 * asin(sqrt(a)) #2*R*asin...
\ No newline at end of file
+    return EARTH_DIAMETER_KM * asin(sqrt(a)) #2*R*asin...
+
+# The same haversine as distance, from one position to arrays of positions at once. Returns kilometres
+def distances(lat, lon, lats, lons):
+    p = pi/180
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    a = 0.5 - numpy.cos((lats-lat)*p)/2 + cos(lat*p) * numpy.cos(lats*p) * (1-numpy.cos((lons-lon)*p))/2
+    return EARTH_DIAMETER_KM * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+# Smallest (minLat, maxLat, minLon, maxLon) containing every position within radius kilometres. minLon is
+# greater than maxLon when the box crosses the antimeridian, and the box spans every longitude near the poles
+def bounding_box(lat, lon, radius):
+    angle = degrees(2 * radius / EARTH_DIAMETER_KM)
+    min_lat = lat - angle
+    max_lat = lat + angle
+    if min_lat <= -90 or max_lat >= 90 or angle >= 180:
+        return max(min_lat, -90), min(max_lat, 90), -180, 180
+
+    # Widest longitude reached by the circle, at the latitude where it touches the box's sides
+    p = pi/180
+    spread = degrees(asin(min(1, sin(angle*p) / cos(lat*p))))
+    min_lon = (lon - spread + 180) % 360 - 180
+    max_lon = (lon + spread + 180) % 360 - 180
+    return min_lat, max_lat, min_lon, max_lon
+
+# Boolean mask of the positions inside a box from bounding_box
+def in_bounding_box(box, lats, lons):
+    min_lat, max_lat, min_lon, max_lon = box
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    inside = (lats >= min_lat) & (lats <= max_lat)
+    if min_lon <= max_lon:
+        return inside & (lons >= min_lon) & (lons <= max_lon)
+    return inside & ((lons >= min_lon) | (lons <= max_lon))
+
+# Returns (indices, distances) of the k positions closest to lat, lon, nearest first and in kilometres.
+# Positions at the same distance are ordered by index. With a radius, positions farther than it are left
+# out, and those outside its bounding box are skipped before any distance is computed.
+# Selects the k nearest with argpartition, so only those k are sorted
+def nearest(lat, lon, lats, lons, k, radius=None):
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    indices = numpy.arange(len(lats))
+    if radius is not None:
+        indices = indices[in_bounding_box(bounding_box(lat, lon, radius), lats, lons)]
+
+    found = distances(lat, lon, lats[indices], lons[indices])
+    if radius is not None:
+        within = found <= radius
+        indices, found = indices[within], found[within]
+
+    if k <= 0:
+        return indices[:0], found[:0]
+    if k < len(found):
+        # Keep every position tied with the k-th nearest, so ties are broken by index rather than by argpartition
+        kth = found[numpy.argpartition(found, k - 1)[k - 1]]
+        keep = found <= kth
+        indices, found = indices[keep], found[keep]
+
+    order = numpy.lexsort((indices, found))[:k]
+    return indices[order], found[order]
@@ -0,0 +1,165 @@
+import queue
+import smtplib
+import ssl
+import threading
+from email.mime.text import MIMEText
+
+# Outbound mail queue. Endpoints enqueue messages and return immediately while a small pool of
+# worker threads delivers them. Each worker keeps one authenticated SMTP connection open and sends
+# everything queued (up to batch_size messages) over it before waiting again, closing it after
+# idle_seconds without mail. Failed messages are retried with exponential backoff.
+
+
+class Mail(object):
+    __slots__ = ("recipient", "subject", "body", "attempts")
+
+    def __init__(self, recipient: str, subject: str, body: str):
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.attempts = 0
+
+    def as_string(self):
+        return "Subject: " + self.subject + "\n" + MIMEText(self.body, 'html').as_string()
+
+
+class MailQueue(object):
+    def __init__(self, host: str, port: int, username: str, password: str, use_ssl: bool = True,
+                 workers: int = 1, batch_size: int = 20, max_size: int = 1000, max_retries: int = 5,
+                 retry_base_seconds: float = 2, idle_seconds: float = 60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.idle_seconds = idle_seconds
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = list()
+        self._retries = set()
+        self._lock = threading.Lock()
+        self._counters = {"sent": 0, "failed": 0, "retried": 0, "connections": 0, "batches": 0}
+
+    # Raises queue.Full if the queue is at capacity
+    def enqueue(self, recipient: str, subject: str, body: str):
+        self._queue.put_nowait(Mail(recipient, subject, body))
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f"mail-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Delivers what is already queued, then stops the workers
+    def stop(self, timeout: float = 30):
+        with self._lock:
+            for timer in self._retries:
+                timer.cancel()
+            self._retries.clear()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics["waitingRetry"] = len(self._retries)
+        metrics["depth"] = self._queue.qsize()
+        metrics["workers"] = len(self._threads)
+        return metrics
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def _connect(self):
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context())
+        else:
+            connection = smtplib.SMTP(self.host, self.port)
+        if self.username:
+            connection.login(self.username, self.password)
+        self._count("connections")
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def _retry(self, mail: Mail):
+        mail.attempts += 1
+        if mail.attempts > self.max_retries:
+            self._count("failed")
+            return
+        self._count("retried")
+
+        def requeue():
+            with self._lock:
+                self._retries.discard(timer)
+            self._queue.put(mail)
+
+        timer = threading.Timer(self.retry_base_seconds * 2 ** (mail.attempts - 1), requeue)
+        timer.daemon = True
+        with self._lock:
+            self._retries.add(timer)
+        timer.start()
+
+    def _take_batch(self, first: Mail):
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                mail = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if mail is None:
+                # Put the stop signal back so it is seen after this batch
+                self._queue.put(None)
+                break
+            batch.append(mail)
+        return batch
+
+    def _work(self):
+        connection = None
+        while True:
+            try:
+                mail = self._queue.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                if connection is not None:
+                    self._close(connection)
+                    connection = None
+                continue
+            if mail is None:
+                break
+
+            batch = self._take_batch(mail)
+            self._count("batches")
+            for mail in batch:
+                # A reused connection may have been dropped by the server, so reconnect once before counting a failure
+                for attempt in range(2):
+                    try:
+                        if connection is None:
+                            connection = self._connect()
+                        connection.sendmail(self.username, mail.recipient, mail.as_string())
+                        self._count("sent")
+                        break
+                    except smtplib.SMTPServerDisconnected:
+                        connection = None
+                        if attempt == 1:
+                            self._retry(mail)
+                    except (smtplib.SMTPException, OSError):
+                        if connection is not None:
+                            self._close(connection)
+                            connection = None
+                        self._retry(mail)
+                        break
+
+        if connection is not None:
+            self._close(connection)
@@ -1,26 +1,40 @@
 import os
 from pathlib import Path
+from queue import Full
 from typing import List
 
-from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile
+from fastapi import (BackgroundTasks, Depends, FastAPI, HTTPException, Request,
+                     Response, UploadFile)
 from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
+import async_crud
 import crud
-from apihelper import (decode_token, get_db, send_reset_email,
-                       send_verification_email, write_files)
-from config import STATIC_FILES_DIRECTORY
+import imageprocessing
+import migrations
+import passwords
+import pooling
+import signedtokens
+import tokencache
+from apihelper import (CachedStaticFiles, check_not_modified,
+                       check_places_not_modified, decode_token, get_async_db,
+                       get_db, mail_queue, process_thumbnails,
+                       remove_stale_uploads, send_reset_email,
+                       send_verification_email, token_reaper, write_files)
+from config import (AUTO_MIGRATE, MAX_CLUSTER_CELLS, MAX_NEAR_RADIUS_KM,
+                    MAX_PLACES_IN_AREA, MAX_RATINGS_PAGE, PLUS_CODE_CACHE_SIZE,
+                    SEARCH_RESULT_LIMIT, STATIC_FILES_DIRECTORY, TOKEN_MODE)
 from crud import *
-from database import engine
+from database import SessionLocal, async_engine, engine
 from models import *
 
 # Taken from https://github.com/google/open-location-code
 # License information can be found in openlocationcode.py
+import openlocationcode
 from openlocationcode import isFull
 from schemas import *
-from schemas import accessLevel, placeOrder, tokenType, visibility, Token
+from schemas import accessLevel, placeOrder, ratingOrder, tokenType, visibility, Token
 
 # Dict of tags and their descriptions to break the OpenAPI docs into sections
 tags_metadata = [
@@ -48,10 +62,20 @@ tags_metadata = [
         "name": "Security",
         "description": "Operations with security.",
     },
+    {
+        "name": "Debug",
+        "description": "Operations for monitoring the API.",
+    },
 ]
 
-# Creates database connections
-models.Base.metadata.create_all(bind=engine)
+# Creates or upgrades the database schema. See migrations.py. Without AUTO_MIGRATE, refuses to start on a schema that
+# is behind these models rather than failing on every query that touches a missing column
+if AUTO_MIGRATE:
+    migrations.upgrade(engine)
+elif migrations.pending(engine):
+    raise RuntimeError("The database schema is out of date. Run python3 manage.py migrate")
+signedtokens.check_configuration()
+openlocationcode.setCacheSize(PLUS_CODE_CACHE_SIZE)
 
 # Initializes the application
 app = FastAPI(openapi_tags=tags_metadata)
@@ -66,6 +90,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Access-Token"],
 )
 
 # Initializes OAuth2 and tells the OpenAPI docs to look at the /login endpoint
@@ -74,19 +99,58 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 # Mounts /usercontent as a static directory at STATIC_FILES_DIRECTORY in config.py. If directory does not exist, make it and mount it
 try:
-    app.mount("/usercontent", StaticFiles(directory=STATIC_FILES_DIRECTORY), name="usercontent")
+    app.mount("/usercontent", CachedStaticFiles(directory=STATIC_FILES_DIRECTORY), name="usercontent")
 except:
     os.mkdir(STATIC_FILES_DIRECTORY)
-    app.mount("/usercontent", StaticFiles(directory=STATIC_FILES_DIRECTORY), name="usercontent")
+    app.mount("/usercontent", CachedStaticFiles(directory=STATIC_FILES_DIRECTORY), name="usercontent")
 
 
-# This method returns the current user from a token
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# This method returns the current user from a token. FastAPI runs it in the threadpool with the same get_db
+# session as the endpoint, so a request checks out a single connection
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     user = decode_token(db, token)
     if user.verified == False:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Account has not been verified")
     return user
 
+# The same for async endpoints, sharing their get_async_db session
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: Session = Depends(get_async_db)):
+    user = await async_crud.run(db, decode_token, token)
+    if user.verified == False:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Account has not been verified")
+    return user
+
+
+
+@app.on_event("startup")
+def start_mail_queue():
+    mail_queue.start()
+
+# Removes partial uploads left by a worker that died while writing them
+@app.on_event("startup")
+def clean_uploads():
+    remove_stale_uploads()
+
+# Deletes expired tokens now and every TOKEN_REAPER_INTERVAL_SECONDS. See tokenreaper.py
+@app.on_event("startup")
+async def start_token_reaper():
+    token_reaper.start()
+
+@app.on_event("shutdown")
+async def stop_token_reaper():
+    await token_reaper.stop()
+
+# Delivers queued mail and writes any expiry extensions still held by the token cache before the worker exits
+@app.on_event("shutdown")
+def shutdown():
+    mail_queue.stop()
+    imageprocessing.shutdown()
+    passwords.shutdown()
+    db = SessionLocal()
+    try:
+        tokencache.flush(db)
+    finally:
+        db.close()
 
 
 # =============================================================================== USERS
@@ -99,7 +163,7 @@ def create_user(user: CreateUser, db: Session = Depends(get_db)):
 
     - username: this must not exceed 20 characters or match another username
     - email: this unique identifier must not exceed 100 characters
-    - rawpassword: this will be the password. Stored hashed with SHA-256
+    - rawpassword: this will be the password. Stored as a salted scrypt hash
 
     Note: Returns a 404 if either the username or emails are taken.
     """
@@ -129,7 +193,7 @@ def set_perms(username: str, accessLevel: accessLevel, callingUser: schemas.Inte
 
     # Only sets perms if the logged in user is admin. Doesn't allow setting other users to admin. Doesn't allow demoting other admins including self
     if callingUser.accessLevel == accessLevel.ADMIN and not accessLevel == accessLevel.ADMIN and not user.accessLevel == accessLevel.ADMIN:
-        set_user_perms(db, username, accessLevel)
+        return set_user_perms(db, username, accessLevel)
     else:
         raise HTTPException(status_code=401, detail="Forbidden") 
 
@@ -174,18 +238,22 @@ def get_user(username: str, user: schemas.InternalUser = Depends(get_current_use
     return db_user
 
 @app.get("/users/", response_model=List[schemas.InternalUser], tags=["Users"])
-def list_users(skip: int = 0, limit: int = 100, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
+def list_users(response: Response, skip: int = 0, limit: int = 100, cursor: str = None, includeImages: bool = True, includeRatings: bool = True, includePlaces: bool = True, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Gets a list of users and their information
 
     - skip: will offset the users returned
     - limit: will return either this amount of users or the number of users after the skip offset, whichever is smaller
+    - cursor: the X-Next-Cursor header of the previous page, to continue after it
+    - includeImages, includeRatings, includePlaces: set to false to leave the user's images, ratings or places out of the response. They are returned as null
 
-    Note: Returns a 403 if user is not an admin
+    Note: Returns a 403 if user is not an admin. Users are ordered by email. The X-Next-Cursor header is only set when more users may follow
     """
     if user.accessLevel != accessLevel.ADMIN:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    users = get_users(db, skip=skip, limit=limit)
+    users, next_cursor = get_users(db, skip=skip, limit=limit, cursor=cursor, images=includeImages, ratings=includeRatings, places=includePlaces)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return users
 
 @app.delete("/user/", status_code=200, tags=["Users"])
@@ -200,7 +268,7 @@ def delete_user(email: str, user: schemas.InternalUser = Depends(get_current_use
     db_user = crud.get_user(db, email)
     if db_user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    if db_user == user:
+    if db_user.email == user.email:
         crud.delete_user(db, email=user.email)
     elif user.accessLevel == accessLevel.ADMIN and db_user.accessLevel != accessLevel.ADMIN:
         crud.delete_user(db, email=user.email)
@@ -224,7 +292,7 @@ def create_place(place: SetPlace, user: schemas.InternalUser = Depends(get_curre
     return crud.create_place(db, place, user)
 
 @app.get("/place/guest/{placeID}", response_model=schemas.GetPlace, tags=["Places"])
-def get_place(placeID: int, db: Session = Depends(get_db)):
+def get_place(placeID: int, request: Request, response: Response, db: Session = Depends(get_db)):
     """
     Gets the information of a palce
 
@@ -232,12 +300,20 @@ def get_place(placeID: int, db: Session = Depends(get_db)):
     - visibility: Determines whether all, verified, or unverified places are displayed
 
     Note: Returns a 404 if the place doesn't exist. Returns a 403 if place is unverified.
+    Responses carry an ETag and Last-Modified that change with the place, its thumbnails and its comments. Returns a 304 if they match the request's If-None-Match or If-Modified-Since.
     """
+    version = crud.get_place_version(db, placeID)
+    if version is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Place not found")
+    if not version.verified:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Place not verified")
+    not_modified = check_not_modified(request, response, f'W/"place-{placeID}-{version.version}"', version.lastModified)
+    if not_modified is not None:
+        return not_modified
+
     db_place = crud.get_place(db, placeID=placeID)
     if db_place is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Place not found")
-    if not db_place.isvisible:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Place not verified")
     return db_place
 
 @app.get("/place/user/{placeID}", response_model=schemas.GetPlace, tags=["Places"])
@@ -259,37 +335,164 @@ def get_place(placeID: int, user: schemas.InternalUser = Depends(get_current_use
     db_place = crud.get_place(db, placeID=placeID)
     return db_place
 
+@app.get("/place/{placeID}/ratings", response_model=List[schemas.GetRating], tags=["Ratings"])
+def list_place_ratings(placeID: int, request: Request, response: Response, order: ratingOrder = ratingOrder.NEWEST, limit: int = 20, cursor: str = None, db: Session = Depends(get_db)):
+    """
+    Gets a page of the ratings of a verified place
+
+    - placeID: ID of the place. Will always be an integer
+    - order: newest first, or highest or lowest ratingValue first
+    - limit: the most ratings to return, from 1 to 100
+    - cursor: the X-Next-Cursor header of the previous page, to continue after it. Only valid for the same place and order
+
+    Note: Returns a 404 if the place doesn't exist. Returns a 403 if place is unverified. The X-Next-Cursor header is only set when more ratings may follow.
+    Responses carry an ETag and Last-Modified that change with the place's ratings. Returns a 304 if they match the request's If-None-Match or If-Modified-Since.
+    """
+    version = crud.get_place_version(db, placeID)
+    if version is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Place not found")
+    if not version.verified:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Place not verified")
+    not_modified = check_not_modified(request, response, f'W/"ratings-{placeID}-{version.version}"', version.lastModified)
+    if not_modified is not None:
+        return not_modified
+
+    ratings, next_cursor = crud.get_place_ratings(db, placeID, order, max(1, min(limit, MAX_RATINGS_PAGE)), cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return ratings
+
 @app.get("/places/guest", response_model=List[schemas.GetPlace], tags=["Places"])
-def list_places(order: placeOrder, latitude: float = 0, longitude: float = 0, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def list_places(order: placeOrder, request: Request, response: Response, latitude: float = 0, longitude: float = 0, skip: int = 0, limit: int = 100, cursor: str = None, db: Session = Depends(get_db)):
     """
     Gets a list of verified places and their information
 
-    - order: determines if results are ordered by distance or rating
+    - order: determines if results are ordered by distance or popularity. Popularity is the stats.score of each place, which weighs the average rating by how many ratings it has
     - skip: will offset the places returned
     - limit: will return either this amount of places or the number of places after the skip offset, whichever is smaller
+    - cursor: the X-Next-Cursor header of the previous page, to continue after it. Prefer it over skip for deep pages
 
-    Note: If sorting by rating, latitude and longitude are not required.
+    Note: If sorting by popularity, latitude and longitude are not required. A distance cursor only works with the same latitude and longitude.
+    The X-Next-Cursor header is only set when more places may follow.
+    Responses carry an ETag that changes whenever any verified place changes. Returns a 304 if it matches the request's If-None-Match.
     """
+    not_modified = check_places_not_modified(db, request, response, "places")
+    if not_modified is not None:
+        return not_modified
+
     if order == placeOrder.POPULARITY:
-        places = get_places_by_popularity(db, skip, limit, visibility.VERIFIED)
+        places, next_cursor = get_places_by_popularity(db, skip, limit, visibility.VERIFIED, cursor)
     else:
-        places = get_places_by_distance(db, latitude, longitude, skip, limit, visibility.VERIFIED)
+        places, next_cursor = get_places_by_distance(db, latitude, longitude, skip, limit, visibility.VERIFIED, cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return places
+
+@app.get("/places/guest/summary", response_model=List[schemas.PlaceSummary], tags=["Places"])
+def list_place_summaries(order: placeOrder, request: Request, response: Response, latitude: float = 0, longitude: float = 0, skip: int = 0, limit: int = 100, cursor: str = None, db: Session = Depends(get_db)):
+    """
+    Gets a list of verified places with only their ID, name, plus code, rating and cover image, for map and list views
+
+    Takes the same parameters as /places/guest and returns the same places in the same order. Cursors from either endpoint work with the other.
+
+    Note: coverImage is the URL of the place's first verified thumbnail, or null if it has none.
+    Responses carry an ETag that changes whenever any verified place changes. Returns a 304 if it matches the request's If-None-Match.
+    """
+    not_modified = check_places_not_modified(db, request, response, "place-summaries")
+    if not_modified is not None:
+        return not_modified
+
+    places, next_cursor = crud.get_place_summaries(db, order, latitude, longitude, skip, limit, visibility.VERIFIED, cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return places
 
+@app.get("/places/within", response_model=schemas.PlacesInArea, tags=["Places"])
+def list_places_within(north: float, south: float, east: float, west: float, request: Request, response: Response, limit: int = MAX_PLACES_IN_AREA, db: Session = Depends(get_db)):
+    """
+    Gets the verified places inside a map viewport
+
+    - north, south: latitudes of the viewport's top and bottom edges
+    - east, west: longitudes of its right and left edges. west is greater than east when the viewport crosses the antimeridian
+    - limit: the most places to list, capped at 500
+
+    Note: places are listed highest rated first. When more than limit places are inside, places is null and clusters instead holds the plus code cells overlapping the viewport as /places/clusters does, with cells sized so there are about 16 across it. total is always the number of places inside.
+    Returns a 400 if the viewport is not valid. Responses carry an ETag that changes whenever any verified place changes. Returns a 304 if it matches the request's If-None-Match.
+    """
+    if not -90 <= south <= north <= 90 or not -180 <= west <= 180 or not -180 <= east <= 180:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid viewport")
+    not_modified = check_places_not_modified(db, request, response, "places-within")
+    if not_modified is not None:
+        return not_modified
+
+    return crud.get_places_within(db, south, west, north, east, max(0, min(limit, MAX_PLACES_IN_AREA)), visibility.VERIFIED)
+
+@app.get("/places/clusters", response_model=List[schemas.PlaceCluster], tags=["Places"])
+def list_place_clusters(level: int, request: Request, response: Response, bbox: str = None, db: Session = Depends(get_db)):
+    """
+    Gets the number, average position and average rating of the verified places in each plus code cell of a map viewport, for zoomed-out maps
+
+    - level: length of the cells' codes, one of 2, 4, 6 or 8. Cells are 20, 1, 0.05 and 0.0025 degrees across respectively
+    - bbox: the viewport as west,south,east,north. west is greater than east when it crosses the antimeridian. Optional for level 2, where it defaults to the whole world, and required for the other levels
+
+    Note: Only cells holding places are listed, ordered by code. A cell's totals include its places outside the viewport. rating is the average of every rating of the cell's places, or -1 if none are rated.
+    Returns a 400 if the level or viewport is not valid, if bbox is missing for a level other than 2, or if the viewport spans more than 10,000 cells of the level. Responses carry an ETag that changes whenever any verified place changes. Returns a 304 if it matches the request's If-None-Match.
+    """
+    if level not in crud.CLUSTER_LEVELS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid level")
+    if bbox is None:
+        if level != min(crud.CLUSTER_LEVELS):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="bbox is required for levels other than 2")
+        bbox = "-180,-90,180,90"
+    try:
+        west, south, east, north = [float(value) for value in bbox.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid bbox")
+    if not -90 <= south <= north <= 90 or not -180 <= west <= 180 or not -180 <= east <= 180:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid bbox")
+    if crud.cells_in_area(level, south, west, north, east) > MAX_CLUSTER_CELLS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="bbox spans too many cells for this level")
+    not_modified = check_places_not_modified(db, request, response, "places-clusters")
+    if not_modified is not None:
+        return not_modified
+
+    return crud.get_place_clusters(db, level, south, west, north, east)
+
+@app.get("/places/near", response_model=schemas.PlacesInArea, tags=["Places"])
+def list_places_near(latitude: float, longitude: float, radiusKm: float, request: Request, response: Response, limit: int = 100, db: Session = Depends(get_db)):
+    """
+    Gets the verified places within a distance of a position, nearest first
+
+    - latitude, longitude: the position
+    - radiusKm: the distance in kilometres, at most 500
+    - limit: the most places to list, capped at 500
+
+    Note: Each place carries its distance in kilometres. total is the number of places within radiusKm, which can be more than are listed. clusters is always null.
+    Returns a 400 if the position or radius is not valid. Responses carry an ETag that changes whenever any verified place changes. Returns a 304 if it matches the request's If-None-Match.
+    """
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180 or not 0 < radiusKm <= MAX_NEAR_RADIUS_KM:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid position or radius")
+    not_modified = check_places_not_modified(db, request, response, "places-near")
+    if not_modified is not None:
+        return not_modified
+
+    return crud.get_places_near(db, latitude, longitude, radiusKm, max(0, min(limit, MAX_PLACES_IN_AREA)), visibility.VERIFIED)
+
 @app.get("/place/{typingQuery}", response_model=List[schemas.SearchPlace], tags=["Places"])
-def get_place(typingQuery: str, db: Session = Depends(get_db)):
+def get_place(typingQuery: str, limit: int = SEARCH_RESULT_LIMIT, db: Session = Depends(get_db)):
     """
-    Gets the names and IDs of places who's friendlyName contain the typingQuery
+    Gets the names and IDs of verified places who's friendlyName contain the typingQuery, highest rated first
 
-    - typingQuery: The string to search for in the friendlyName of the place
+    - typingQuery: The string to search for in the friendlyName of the place. Not case sensitive
+    - limit: will return at most this amount of places
 
-    Note: Returns null if nothing exists.
+    Note: Returns an empty list if nothing exists.
     """
-    db_place = crud.get_place_names(db, typingQuery)
+    db_place = crud.get_place_names(db, typingQuery, limit)
     return db_place
 
 @app.patch("/place/{placeID}", response_model=GetPlace, tags=["Places"])
-async def update_item(patch_place: PatchPlace, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_item(patch_place: PatchPlace, user: schemas.InternalUser = Depends(get_current_user_async), db: Session = Depends(get_async_db)):
     """
     Updates a place
 
@@ -304,13 +507,13 @@ async def update_item(patch_place: PatchPlace, user: schemas.InternalUser = Depe
 
     if patch_place.plusCode is not None and not isFull(patch_place.plusCode):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid PlusCode")
-    db_place = crud.get_place(db, patch_place.placeID)
+    db_place = await async_crud.get_place(db, patch_place.placeID)
     if db_place is None:
         raise HTTPException(status_code=404, detail="Place not found")
     if user.accessLevel == accessLevel.ADMIN or user.username == db_place.posterID:
         update_data = patch_place.dict(exclude_unset=True)
         updated_place = PatchPlace(**jsonable_encoder(db_place.copy(update=update_data)))
-        place = crud.update_place(db, updated_place)
+        place = await async_crud.update_place(db, updated_place)
         return place
     else:
         raise HTTPException(status_code=401, detail="Forbidden")
@@ -337,22 +540,25 @@ def delete_place(placeID: int, user: InternalUser = Depends(get_current_user), d
 
 
 @app.post("/uploadThumbnails/", status_code=status.HTTP_201_CREATED, tags=["Thumbnails"])
-async def create_upload_file(files: List[UploadFile], placeID: int, db: Session = Depends(get_db), user: schemas.InternalUser = Depends(get_current_user)):
+async def create_upload_file(files: List[UploadFile], placeID: int, background_tasks: BackgroundTasks, db: Session = Depends(get_async_db), user: schemas.InternalUser = Depends(get_current_user_async)):
     """
     Uploads a series of thumbnails
 
     - files: the series of files to upload
     - placeID: the placeID to associate the uploaded files to. Will always be an integer
 
-    Note: Returns a 404 if the place doesn't exist. Returns a 403 if a user tries to upload images to a place they didn't post. Admins can add images to any place
+    Note: Returns a 404 if the place doesn't exist. Returns a 403 if a user tries to upload images to a place they didn't post. Admins can add images to any place.
+    Resized WebP/AVIF copies are generated after the response is sent and appear in the thumbnail's variants and srcset once ready.
     """
-    place = crud.get_place(db, placeID)
+    place = await async_crud.get_place(db, placeID)
     if place is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Place not found")
     path = Path(STATIC_FILES_DIRECTORY + str(placeID))
     
     if place.posterID == user.username or user.accessLevel == accessLevel.ADMIN:
-        crud.add_thumbnail_urls(db, await write_files(path, files, get_thumbnail_urls(db, placeID)), placeID, user)
+        urls = await write_files(path, files, await async_crud.get_thumbnail_urls(db, placeID))
+        thumbnails = await async_crud.add_thumbnail_urls(db, urls, placeID, user)
+        background_tasks.add_task(process_thumbnails, thumbnails)
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
 
@@ -365,7 +571,7 @@ def get_thumbnails_from_place(placeID: int, db: Session = Depends(get_db)):
 
     Note: Returns a 404 if the image doesn't exist. Marked deprecated as getting a place also returns a list of thumbnails
     """
-    return crud.get_thumbnails_from_place(db, placeID=placeID)
+    return crud.get_thumbnails_from_place(db, placeID=placeID, show_unverified=False)
     
 @app.delete("/thumbnails/{thumbnailID}", status_code=status.HTTP_200_OK, tags=["Thumbnails"])
 def delete_thumbnail(imageID: int, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
@@ -424,7 +630,7 @@ def create_rating(rating: SetRating, user: schemas.InternalUser = Depends(get_cu
     return crud.create_rating(db, rating, user)
 
 @app.patch("/rating/{ratingID}", response_model=GetRating, tags=["Ratings"])
-async def update_rating(ratingID: int, patch_rating: PatchRating, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_rating(ratingID: int, patch_rating: PatchRating, user: schemas.InternalUser = Depends(get_current_user_async), db: Session = Depends(get_async_db)):
     """
     Updates a rating
 
@@ -434,14 +640,16 @@ async def update_rating(ratingID: int, patch_rating: PatchRating, user: schemas.
 
     Note: Returns a 404 if the rating doesn't exist. Returns a 403 if the user is trying to modify someone else's rating.
     """
-    db_rating = crud.get_rating(db, ratingID)
+    db_rating = await async_crud.get_rating(db, ratingID)
     if db_rating is None:
         raise HTTPException(status_code=404, detail="Rating not found")
+    if patch_rating.ratingValue is not None and (patch_rating.ratingValue < 1 or patch_rating.ratingValue > 5):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Rating must be between 1 and 5")
     if user.username == db_rating.username:
         # Taken from the FastAPI docs regarding partial data updates. Idk how it works but it does
         update_data = patch_rating.dict(exclude_unset=True)
         updated_rating = GetRating(**jsonable_encoder(db_rating.copy(update=update_data)))
-        rating = crud.update_rating(db, updated_rating)
+        rating = await async_crud.update_rating(db, updated_rating)
         return rating
     else:
         raise HTTPException(status_code=401, detail="Forbidden")
@@ -468,16 +676,19 @@ def delete_rating(ratingID: int, user: InternalUser = Depends(get_current_user),
 
 
 @app.get("/places/verification", response_model=List[schemas.GetPlace], tags=["Moderation"])
-def list_unverified_places(skip: int = 0, limit: int = 100, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
+def list_unverified_places(response: Response, skip: int = 0, limit: int = 100, cursor: str = None, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Gets a list of unverified places and their information
 
     - skip: will offset the places returned
     - limit: will return either this amount of places or the number of places after the skip offset, whichever is smaller
+    - cursor: the X-Next-Cursor header of the previous page, to continue after it
     """
     if user.accessLevel == accessLevel.USER:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    places = get_places_by_popularity(db, skip, limit, visibility.UNVERIFIED)
+    places, next_cursor = get_places_by_popularity(db, skip, limit, visibility.UNVERIFIED, cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return places
 
 @app.post("/places/setverification", status_code=status.HTTP_200_OK, tags=["Moderation"])
@@ -499,16 +710,20 @@ def set_place_verified(isverified: bool, placeID: int, db: Session = Depends(get
     set_place_visibility(db, placeID, isverified)
 
 @app.get("/images/verification", response_model=List[schemas.Thumbnail], tags=["Moderation"])
-def list_unverified_images(skip: int = 0, limit: int = 100, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
+def list_unverified_images(response: Response, skip: int = 0, limit: int = 100, cursor: str = None, user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Gets a list of unverified images and their information
 
     - skip: will offset the images returned
     - limit: will return either this amount of images or the number of images after the skip offset, whichever is smaller
+    - cursor: the X-Next-Cursor header of the previous page, to continue after it
     """
     if user.accessLevel == accessLevel.USER:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    return get_unverified_thumbnails(db, skip, limit)
+    images, next_cursor = get_unverified_thumbnails(db, skip, limit, cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return images
 
 @app.post("/images/setverification", status_code=status.HTTP_200_OK, tags=["Moderation"])
 def set_image_verified(isverified: bool, imageID: int, db: Session = Depends(get_db), user: schemas.InternalUser = Depends(get_current_user)):
@@ -532,75 +747,98 @@ def set_image_verified(isverified: bool, imageID: int, db: Session = Depends(get
 # =============================================================================== SECURITY
 
 @app.post("/login", tags=["Security"])
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_async_db)):
     """
     Generates a user ACCOUNT token.
 
     - Requires OAuth2 form data to be sent
 
     Note: Returns a 400 if either the email or password are incorrect.
+    Passwords stored with an outdated hash are rehashed with the current settings on a successful login.
     """
-    user = crud.get_user(db, form_data.username)
+    user = await async_crud.get_user(db, form_data.username)
     if not user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect username or password")
     if user.verified == False:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Account has not been verified")
-    hashed_password = crud.hash_password(form_data.password)
-    if not hashed_password == user.hashed_password:
+    if not await passwords.verify_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect username or password")
+    if passwords.needs_rehash(user.hashed_password):
+        await async_crud.set_password_hash(db, user.email, await passwords.hash_async(form_data.password))
 
-    access_token = create_token(db, email=form_data.username, type=tokenType.ACCOUNT)
+    access_token = await async_crud.create_token(db, email=form_data.username, type=tokenType.ACCOUNT)
 
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/refreshToken", response_model=schemas.InternalUser, tags=["Security"])
-async def refresh_token(user: schemas.InternalUser = Depends(get_current_user), db: Session = Depends(get_db)):
+async def refresh_token(response: Response, user: schemas.InternalUser = Depends(get_current_user_async), db: Session = Depends(get_async_db)):
     """
     Attempts to refresh the logged in user's token
 
     - Tokens expire 15 minutes after they've either been issued initially or refreshed with this endpoint
 
     Note: Returns a 400 if the token is bad or has expired. Requires reauthentication.
+    When the server uses signed tokens, which cannot be extended, a new token is returned in the X-Access-Token header and replaces the old one.
+    """
+    if TOKEN_MODE == "signed":
+        response.headers["X-Access-Token"] = await async_crud.create_token(db, user.email, tokenType.ACCOUNT)
+    else:
+        await async_crud.refresh_token_by_user(db, user)
+    return user
+
+@app.post("/logout", status_code=status.HTTP_200_OK, tags=["Security"])
+async def logout(user: schemas.InternalUser = Depends(get_current_user_async), db: Session = Depends(get_async_db)):
+    """
+    Signs the logged in user out of every session
+
+    Note: Every token of the user stops working, including signed ones.
     """
-    crud.refresh_token_by_user(db, crud.get_user(db, user.email))
+    await async_crud.sign_out(db, user.email)
 
 @app.post("/verifyAccount", status_code=status.HTTP_200_OK, tags=["Security"])
-async def verify_token(token: schemas.Token, db: Session = Depends(get_db)):
+async def verify_token(token: schemas.Token, db: Session = Depends(get_async_db)):
     """
     Attempts to verify a user account given a VERIFICATION type token
 
-    - VERIFICATION tokens never expire
+    - VERIFICATION tokens expire after 72 hours. /resentVerificationEmail sends a new one
 
-    Note: Returns a 400 if the token is invalid.
+    Note: Returns a 400 if the token is invalid or has expired.
     """
-    token_obj = crud.get_token_by_token(db, token.token)
-    if not token and not token_obj.type == tokenType.VERIFICATION:
+    token_obj = await async_crud.get_token_by_token(db, token.token)
+    if token_obj is None or token_obj.type != tokenType.VERIFICATION:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad token")
-    verify_account(db, token.token)
+    await async_crud.verify_account(db, token.token)
 
 @app.post("/resentVerificationEmail", status_code=status.HTTP_200_OK, tags=["Security"])
-async def verify_email(email: str, db: Session = Depends(get_db)):
+async def verify_email(email: str, db: Session = Depends(get_async_db)):
     """
     Resends verification email
 
     - email: email to resend to
 
-    Note: Returns a 404 if the email has no associated token.
+    Note: Returns a 404 if the email has no associated user. Sends the user's current token, or a new one if it has expired.
     """
-    user = crud.get_user_from_username(db, email)
+    user = await async_crud.get_user(db, email)
     
     if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User with that email does not exist")
-
-    token = crud.get_token_by_user(db, user.username, tokenType.VERIFICATION)
-
-    if token is None:
+    if user.verified:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already verified")
 
-    send_verification_email(user, token)
+    # Expired tokens may already have been deleted by the token reaper
+    token_obj = await async_crud.get_token_by_user(db, user.email, tokenType.VERIFICATION)
+    if token_obj is None or token_obj.expires < datetime.now():
+        token = await async_crud.create_token(db, user.email, tokenType.VERIFICATION)
+    else:
+        token = token_obj.token
+
+    try:
+        send_verification_email(user, token)
+    except Full:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Email could not be sent")
 
 @app.post("/forgotpassword", status_code=status.HTTP_200_OK, tags=["Security"])
-async def forgot_password(email: str, request: Request, db: Session = Depends(get_db)):
+async def forgot_password(email: str, request: Request, db: Session = Depends(get_async_db)):
     """
     Sends an email containing a token to reset an account password
 
@@ -608,22 +846,21 @@ async def forgot_password(email: str, request: Request, db: Session = Depends(ge
 
     Note: Returns a 404 if the email has no associated token.
     """
-    user = crud.get_user(db, email)
+    user = await async_crud.get_user(db, email)
     
     if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User with that email does not exist")
 
-    token = crud.get_token_by_user(db, user.email, tokenType.PASSRESET)
-    if token is not None:
-        db.delete(token)
-        db.commit()
-
-    token = crud.create_token(db, user.email, tokenType.PASSRESET)
+    # Replaces any previous PASSRESET token of the user
+    token = await async_crud.create_token(db, user.email, tokenType.PASSRESET)
     requesting_ip = request.client.host
-    send_reset_email(user, token, requesting_ip)
+    try:
+        send_reset_email(user, token, requesting_ip)
+    except Full:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Email could not be sent")
 
 @app.get("/resetpassword", status_code=status.HTTP_200_OK, tags=["Security"])
-async def verify_token(token: str, new_password: str, db: Session = Depends(get_db)):
+async def verify_token(token: str, new_password: str, db: Session = Depends(get_async_db)):
     """
     Attempts to reset a user account password given a PASSRESET type token
 
@@ -631,13 +868,32 @@ async def verify_token(token: str, new_password: str, db: Session = Depends(get_
 
     Note: Returns a 400 if the token is invalid.
     """
-    token_obj = crud.get_token_by_token(db, token)
+    token_obj = await async_crud.get_token_by_token(db, token)
     if token_obj is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad token")
     elif token_obj.expires < datetime.now() or not token_obj.type == tokenType.PASSRESET:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad token")
-    reset_password(db, new_password, token)
-    db.delete(get_token_by_user(db, token_obj.email, tokenType.ACCOUNT))
-    db.delete(token_obj)
-    db.commit
+    await async_crud.reset_password(db, await passwords.hash_async(new_password), token)
+
 # =============================================================================== DEBUG
+
+
+@app.get("/debug/metrics", tags=["Debug"])
+def get_metrics(user: schemas.InternalUser = Depends(get_current_user)):
+    """
+    Gets internal counters of the API, such as the outgoing mail queue depth, thumbnails that could not be resized, the expired tokens deleted, database connection pool usage and plus code cache hits
+
+    Note: Returns a 403 if user is not an admin
+    """
+    if user.accessLevel != accessLevel.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    metrics = {
+        "mail": mail_queue.metrics(),
+        "thumbnails": imageprocessing.metrics(),
+        "tokenReaper": token_reaper.metrics(),
+        "databasePool": pooling.metrics(engine),
+        "plusCodeCache": openlocationcode.cacheInfo()
+    }
+    if async_engine is not None:
+        metrics["asyncDatabasePool"] = pooling.metrics(async_engine.sync_engine)
+    return metrics
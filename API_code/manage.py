@@ -0,0 +1,96 @@
+import argparse
+import sys
+
+import crud
+import migrations
+import queryplans
+import signedtokens
+from config import TOKEN_REAPER_BATCH_SIZE
+from database import SessionLocal, engine
+from tokenreaper import TokenReaper
+
+# Maintenance commands for the API's database. Run from this directory, e.g.
+#   python3 manage.py migrate
+#   python3 manage.py repair-ratings
+
+
+def migrate(args):
+    if args.status:
+        steps = migrations.pending(engine)
+        for number, description in steps:
+            print(f"Pending {number}: {description}")
+        if not steps:
+            print(f"Database is at version {migrations.LATEST_VERSION}")
+        return
+
+    steps = migrations.upgrade(engine)
+    for number, description in steps:
+        print(f"Applied {number}: {description}")
+    if not steps:
+        print(f"Database is already at version {migrations.LATEST_VERSION}")
+
+def explain(args):
+    failed = 0
+    for name, statement, problems in queryplans.explain(engine):
+        if problems:
+            failed += 1
+            print(f"FAIL {name}: {'; '.join(problems)}")
+            print(f"    {' '.join(statement.split())}")
+        elif args.verbose:
+            print(f"ok   {name}: {' '.join(statement.split())}")
+    if failed:
+        print(f"{failed} queries are not served by an index")
+        sys.exit(1)
+    print("Every checked query is served by an index")
+
+def generate_signing_key(args):
+    print("Add to TOKEN_SIGNING_KEYS in secret_config.py, under a new key ID:")
+    print(f'    "{args.id}": "{signedtokens.generate_key()}",')
+
+def repair_ratings(args):
+    db = SessionLocal()
+    try:
+        updated = crud.repair_scores(db)
+    finally:
+        db.close()
+    print(f"Recomputed rating totals for {updated} places")
+
+def rebuild_clusters(args):
+    db = SessionLocal()
+    try:
+        cells = crud.rebuild_place_clusters(db)
+    finally:
+        db.close()
+    print(f"Rebuilt {cells} place clusters")
+
+def reap_tokens(args):
+    reclaimed = TokenReaper(batch_size=TOKEN_REAPER_BATCH_SIZE).sweep()
+    print(f"Deleted {reclaimed} expired tokens")
+
+
+# name: (function, help, [(flags, argparse options)])
+commands = {
+    "migrate": (migrate, "Create the database or apply pending schema migrations", [
+        (["--status"], {"action": "store_true", "help": "only list the migrations that would be applied"}),
+    ]),
+    "explain": (explain, "Check that every crud query is served by an index, using the database's EXPLAIN", [
+        (["--verbose", "-v"], {"action": "store_true", "help": "also list the queries that passed"}),
+    ]),
+    "generate-signing-key": (generate_signing_key, "Print a new random key for signed ACCOUNT tokens", [
+        (["--id"], {"default": "2", "help": "key ID to print the key under"}),
+    ]),
+    "repair-ratings": (repair_ratings, "Recompute every place's rating sum, count and average from its comments", []),
+    "rebuild-clusters": (rebuild_clusters, "Recompute the place counts and ratings of every plus code cell, e.g. after editing places in the database by hand", []),
+    "reap-tokens": (reap_tokens, "Delete every expired token now, as the API does every TOKEN_REAPER_INTERVAL_SECONDS", []),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NeverBeen API maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help, arguments) in commands.items():
+        subparser = subparsers.add_parser(name, help=help)
+        for flags, options in arguments:
+            subparser.add_argument(*flags, **options)
+
+    args = parser.parse_args()
+    commands[args.command][0](args)
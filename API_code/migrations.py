@@ -0,0 +1,238 @@
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Index, Integer,
+                        MetaData, String, Table, inspect, text)
+from sqlalchemy.engine import Connection, Engine
+
+import models
+import placeclusters
+from config import (SCORE_PRIOR_MEAN, SCORE_PRIOR_WEIGHT,
+                    VERIFICATION_TOKEN_HOURS)
+
+# Versioned schema changes. The database records the last migration applied to it in the
+# schema_version table, and upgrade() applies every later one in order, each in its own
+# transaction. A database without any tables is created straight from models and stamped
+# with the latest version, so MIGRATIONS only has to bring older databases up to date.
+# Databases created before this module existed have no schema_version table and start at 0.
+#
+# Migrations describe the schema as it was when they were written rather than importing
+# models, so later model changes never alter what an old migration does. Every step checks
+# the live schema first, which makes them safe to rerun on partially upgraded databases.
+#
+# To change the schema, update models and append a new migration here. Never edit one that
+# has already been released.
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    _version_metadata,
+    Column("version", Integer, nullable=False),
+)
+
+
+def _columns(conn: Connection, table: str):
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+def _indexes(conn: Connection, table: str):
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+def add_column(conn: Connection, table: str, column: Column):
+    if column.name in _columns(conn, table):
+        return
+    ddl = f"ALTER TABLE {table} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    conn.execute(text(ddl))
+
+def add_index(conn: Connection, table: str, name: str, *columns: str):
+    if name in _indexes(conn, table):
+        return
+    reflected = Table(table, MetaData(), autoload_with=conn)
+    Index(name, *[reflected.c[column] for column in columns]).create(conn)
+
+# =============================================================================== MIGRATIONS
+
+# Coordinates for the spatial index, rating totals for atomic score updates and the version
+# and timestamp used by HTTP cache validators
+def _place_columns(conn: Connection):
+    add_column(conn, "places", Column("latitude", Float))
+    add_column(conn, "places", Column("longitude", Float))
+    add_column(conn, "places", Column("ratingSum", Integer, nullable=False, server_default="0"))
+    add_column(conn, "places", Column("ratingCount", Integer, nullable=False, server_default="0"))
+    add_column(conn, "places", Column("version", Integer, nullable=False, server_default="1"))
+    add_column(conn, "places", Column("lastModified", DateTime))
+
+    # Totals start from the comments that already exist. Coordinates are filled in by spatialindex the first time it loads
+    conn.execute(text(
+        "UPDATE places SET "
+        "ratingSum = (SELECT COALESCE(SUM(comments.ratingValue), 0) FROM comments WHERE comments.placeID = places.placeID), "
+        "ratingCount = (SELECT COUNT(comments.ratingID) FROM comments WHERE comments.placeID = places.placeID)"
+    ))
+
+    # Cursors compare ratings for equality, so they must not be rounded to single precision. SQLite always stores 8 byte floats
+    if conn.dialect.name == "mysql":
+        conn.execute(text("ALTER TABLE places MODIFY rating DOUBLE"))
+
+# Resized copies of uploaded thumbnails
+def _image_variants(conn: Connection):
+    metadata = MetaData()
+    Table("images", metadata, autoload_with=conn)
+    Table(
+        "image_variants",
+        metadata,
+        Column("variantID", Integer, primary_key=True, autoincrement=True),
+        Column("imageID", Integer, ForeignKey("images.imageID", ondelete="CASCADE"), nullable=False),
+        Column("width", Integer, nullable=False),
+        Column("format", String(10), nullable=False),
+        Column("externalURL", String(200), nullable=False),
+        Column("internalURL", String(200), nullable=False),
+    ).create(conn, checkfirst=True)
+
+# One index per query shape in crud. Check them with "python3 manage.py explain"
+def _query_indexes(conn: Connection):
+    add_index(conn, "places", "ix_places_verified_rating", "verified", "rating", "placeID")
+    add_index(conn, "places", "ix_places_verified_version", "verified", "version", "lastModified")
+    add_index(conn, "places", "ix_places_posterID_rating", "posterID", "rating")
+    add_index(conn, "comments", "ix_comments_placeID_ratingID", "placeID", "ratingID")
+    add_index(conn, "comments", "ix_comments_username", "username")
+    add_index(conn, "images", "ix_images_verified_imageID", "verified", "imageID")
+    add_index(conn, "images", "ix_images_placeID_verified", "placeID", "verified", "imageID")
+    add_index(conn, "images", "ix_images_uploader_verified", "uploader", "verified")
+    add_index(conn, "image_variants", "ix_image_variants_imageID", "imageID", "width")
+
+# Paging a place's comments by star rating
+def _comment_rating_index(conn: Connection):
+    add_index(conn, "comments", "ix_comments_placeID_ratingValue", "placeID", "ratingValue", "ratingID")
+
+# Rating histogram and the Bayesian score popularity listings are ordered by
+def _place_stats(conn: Connection):
+    for stars in range(1, 6):
+        add_column(conn, "places", Column(f"stars{stars}", Integer, nullable=False, server_default="0"))
+    add_column(conn, "places", Column("score", Float(precision=53)))
+
+    conn.execute(text("UPDATE places SET " + ", ".join(
+        f"stars{stars} = (SELECT COUNT(comments.ratingID) FROM comments WHERE comments.placeID = places.placeID AND comments.ratingValue = {stars})"
+        for stars in range(1, 6)
+    )))
+    conn.execute(
+        text("UPDATE places SET score = (:weight * :mean + ratingSum) * 1.0 / (:weight + ratingCount)"),
+        {"weight": SCORE_PRIOR_WEIGHT, "mean": SCORE_PRIOR_MEAN}
+    )
+
+    add_index(conn, "places", "ix_places_verified_score", "verified", "score", "placeID")
+    if "ix_places_verified_rating" in _indexes(conn, "places"):
+        conn.execute(text("DROP INDEX ix_places_verified_rating" + (" ON places" if conn.dialect.name == "mysql" else "")))
+
+# Room for salted hashes with their parameters, see passwords.py. SQLite does not enforce lengths
+def _password_hash_length(conn: Connection):
+    if conn.dialect.name == "mysql":
+        conn.execute(text("ALTER TABLE users MODIFY hashed_password VARCHAR(255) NOT NULL"))
+
+# Per user revocation times for signed ACCOUNT tokens
+def _token_revocations(conn: Connection):
+    Table(
+        "token_revocations",
+        MetaData(),
+        Column("email", String(100), primary_key=True),
+        Column("notBefore", Float(precision=53), nullable=False),
+    ).create(conn, checkfirst=True)
+
+# Expired tokens are now deleted by tokenreaper.py. VERIFICATION tokens were stored with expires set to the
+# time they were issued, so that is moved to when they now run out
+def _token_expiry(conn: Connection):
+    add_index(conn, "tokens", "ix_tokens_expires", "expires")
+    if conn.dialect.name == "mysql":
+        update = "UPDATE tokens SET expires = DATE_ADD(expires, INTERVAL :hours HOUR) WHERE type = 'VERIFICATION'"
+    else:
+        update = "UPDATE tokens SET expires = datetime(expires, '+' || :hours || ' hours') WHERE type = 'VERIFICATION'"
+    conn.execute(text(update), {"hours": VERIFICATION_TOKEN_HOURS})
+
+# Places inside a latitude and longitude box
+def _place_position_index(conn: Connection):
+    add_index(conn, "places", "ix_places_verified_latitude", "verified", "latitude", "longitude")
+
+# Totals of the verified places in each plus code cell of length 2, 4, 6 and 8, filled from the places already stored
+def _place_clusters(conn: Connection):
+    if "place_clusters" in inspect(conn).get_table_names():
+        return
+    place_clusters = Table(
+        "place_clusters",
+        MetaData(),
+        Column("level", Integer, primary_key=True),
+        Column("cell", String(8), primary_key=True),
+        Column("south", Float(precision=53), nullable=False),
+        Column("west", Float(precision=53), nullable=False),
+        Column("placeCount", Integer, nullable=False, server_default="0"),
+        Column("ratingSum", Integer, nullable=False, server_default="0"),
+        Column("ratingCount", Integer, nullable=False, server_default="0"),
+        Column("latitudeSum", Float(precision=53), nullable=False, server_default="0"),
+        Column("longitudeSum", Float(precision=53), nullable=False, server_default="0"),
+        Index("ix_place_clusters_level_south", "level", "south", "west"),
+    )
+    place_clusters.create(conn)
+
+    places = conn.execute(text("SELECT plusCode, latitude, longitude, ratingSum, ratingCount FROM places WHERE verified = 1")).all()
+    rows = placeclusters.cluster_rows(places, (2, 4, 6, 8))
+    if rows:
+        conn.execute(place_clusters.insert(), rows)
+
+
+# Ordered list of (version, description, function). Versions must be consecutive
+MIGRATIONS = [
+    (1, "Store coordinates, rating totals and cache validators on places", _place_columns),
+    (2, "Add the image_variants table", _image_variants),
+    (3, "Add indexes for the hot crud queries", _query_indexes),
+    (4, "Index comments by place and star rating", _comment_rating_index),
+    (5, "Add rating histograms and scores to places", _place_stats),
+    (6, "Widen users.hashed_password for salted hashes", _password_hash_length),
+    (7, "Add the token_revocations table", _token_revocations),
+    (8, "Index token expiry and give VERIFICATION tokens a real one", _token_expiry),
+    (9, "Index places by position", _place_position_index),
+    (10, "Add the place_clusters table of per cell place totals", _place_clusters),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# =============================================================================== VERSIONING
+
+# Returns the version recorded in the database, 0 for a database made before migrations, or None for an empty database
+def current_version(conn: Connection):
+    tables = inspect(conn).get_table_names()
+    if schema_version.name in tables:
+        version = conn.execute(schema_version.select()).scalar()
+        if version is not None:
+            return version
+    return 0 if models.Place.__tablename__ in tables else None
+
+def _stamp(conn: Connection, version: int):
+    schema_version.create(conn, checkfirst=True)
+    if conn.execute(schema_version.update().values(version=version)).rowcount == 0:
+        conn.execute(schema_version.insert().values(version=version))
+
+# Brings the database up to date. Returns the list of (version, description) applied
+def upgrade(engine: Engine):
+    with engine.begin() as conn:
+        version = current_version(conn)
+        if version is None:
+            models.Base.metadata.create_all(bind=conn)
+            _stamp(conn, LATEST_VERSION)
+            return [(LATEST_VERSION, "Created the schema from models")]
+
+    applied = list()
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            _stamp(conn, number)
+        applied.append((number, description))
+    return applied
+
+# Returns the list of (version, description) not yet applied to the database
+def pending(engine: Engine):
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version is None:
+        return [(LATEST_VERSION, "Create the schema from models")]
+    return [(number, description) for number, description, _ in MIGRATIONS if number > version]
@@ -1,8 +1,9 @@
 # Installed from PIP. More information at https://www.sqlalchemy.org/
 from sqlalchemy import (Boolean, Column, DateTime, Enum, Float, ForeignKey,
-                        Integer, String)
+                        Index, Integer, String)
+from sqlalchemy.orm import relationship
 
-from config import TOKEN_LENGTH
+from config import IMAGE_SRCSET_FORMAT, TOKEN_LENGTH
 from database import Base
 from schemas import accessLevel, tokenType
 
@@ -13,24 +14,92 @@ class User(Base):
     username = Column(String(20), unique=True)
     email = Column(String(100), primary_key=True)
     verified = Column(Boolean, nullable=False)
-    hashed_password = Column(String(100), nullable=False)
+    # See passwords.py for the format
+    hashed_password = Column(String(255), nullable=False)
     accessLevel = Column(Enum(accessLevel), nullable=False)
     accountCreated = Column(DateTime)
 
 class Place(Base):
     __tablename__ = "places"
+    __table_args__ = (
+        # Popularity listings and their cursors
+        Index("ix_places_verified_score", "verified", "score", "placeID"),
+        # Covers the count, version sum and latest change used by listing ETags
+        Index("ix_places_verified_version", "verified", "version", "lastModified"),
+        # A user's places, highest rated first
+        Index("ix_places_posterID_rating", "posterID", "rating"),
+        # Places inside a map viewport or around a position
+        Index("ix_places_verified_latitude", "verified", "latitude", "longitude"),
+    )
 
     placeID = Column(Integer, primary_key=True, autoincrement=True)
     posterID = Column(String(20), ForeignKey("users.username", ondelete="CASCADE", onupdate="CASCADE"))
     plusCode = Column(String(100), nullable=False)
+    latitude = Column(Float)
+    longitude = Column(Float)
     friendlyName = Column(String(100), nullable=False)
     country = Column(String(6))
     description = Column(String(1000))
-    rating = Column(Float)
+    # Double precision, so the rounded averages compare exactly against cursor values
+    rating = Column(Float(precision=53))
+    ratingSum = Column(Integer, nullable=False, default=0, server_default="0")
+    ratingCount = Column(Integer, nullable=False, default=0, server_default="0")
+    # Number of ratings of each star value
+    stars1 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars2 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars3 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars4 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars5 = Column(Integer, nullable=False, default=0, server_default="0")
+    # Bayesian average used to order places by popularity. See crud.SCORE_EXPRESSION
+    score = Column(Float(precision=53))
     verified = Column(Boolean, nullable=False)
+    # Bumped whenever the place, its thumbnails or its comments change, to validate cached responses
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    lastModified = Column(DateTime)
+
+    # Rows are removed by the database's ON DELETE CASCADE, so the ORM never touches children on delete
+    thumbnails = relationship("Thumbnail", order_by="Thumbnail.imageID", passive_deletes="all")
+    verifiedThumbnails = relationship(
+        "Thumbnail",
+        primaryjoin="and_(Place.placeID == Thumbnail.placeID, Thumbnail.verified == True)",
+        order_by="Thumbnail.imageID",
+        viewonly=True
+    )
+    comments = relationship("Comment", order_by="Comment.ratingID", passive_deletes="all")
+
+# Running totals of the verified places in each plus code cell, at every level of crud.CLUSTER_LEVELS, so
+# zoomed-out maps read a handful of rows instead of every place. Kept up to date by crud as places and
+# ratings change. Cells whose places are all gone keep their row with a placeCount of 0
+class PlaceCluster(Base):
+    __tablename__ = "place_clusters"
+    __table_args__ = (
+        # Cells inside a map viewport
+        Index("ix_place_clusters_level_south", "level", "south", "west"),
+    )
+
+    level = Column(Integer, primary_key=True)
+    # The cell's code without padding, e.g. 86FR for 86FR0000+
+    cell = Column(String(8), primary_key=True)
+    # Corner of the cell
+    south = Column(Float(precision=53), nullable=False)
+    west = Column(Float(precision=53), nullable=False)
+    placeCount = Column(Integer, nullable=False, default=0, server_default="0")
+    # Of the places' comments, for their average rating
+    ratingSum = Column(Integer, nullable=False, default=0, server_default="0")
+    ratingCount = Column(Integer, nullable=False, default=0, server_default="0")
+    # Of the places' positions, for their average position
+    latitudeSum = Column(Float(precision=53), nullable=False, default=0, server_default="0")
+    longitudeSum = Column(Float(precision=53), nullable=False, default=0, server_default="0")
 
 class Comment(Base):
     __tablename__ = "comments"
+    __table_args__ = (
+        # A place's comments in posting order, and its rating totals
+        Index("ix_comments_placeID_ratingID", "placeID", "ratingID"),
+        # A place's comments by star rating
+        Index("ix_comments_placeID_ratingValue", "placeID", "ratingValue", "ratingID"),
+        Index("ix_comments_username", "username"),
+    )
 
     ratingID = Column(Integer, primary_key=True, autoincrement=True)
     placeID = Column(Integer, ForeignKey("places.placeID", ondelete="CASCADE"))
@@ -42,6 +111,13 @@ class Comment(Base):
 
 class Thumbnail(Base):
     __tablename__ = "images"
+    __table_args__ = (
+        # Moderation queue and its cursors
+        Index("ix_images_verified_imageID", "verified", "imageID"),
+        # A place's thumbnails, optionally only verified ones
+        Index("ix_images_placeID_verified", "placeID", "verified", "imageID"),
+        Index("ix_images_uploader_verified", "uploader", "verified"),
+    )
 
     imageID = Column(Integer, primary_key=True, autoincrement=True)
     uploader = Column(String(20), nullable=False)
@@ -51,9 +127,40 @@ class Thumbnail(Base):
     internalURL = Column(String(200), nullable=False)
     uploadDate = Column(DateTime, nullable=False)
 
+    variants = relationship("ThumbnailVariant", order_by="ThumbnailVariant.width", passive_deletes="all")
+
+    # Responsive image candidates, e.g. "https://.../a-320.webp 320w, https://.../a-640.webp 640w"
+    @property
+    def srcset(self):
+        candidates = [f"{variant.externalURL} {variant.width}w" for variant in self.variants if variant.format == IMAGE_SRCSET_FORMAT]
+        return ", ".join(candidates) if candidates else None
+
+class ThumbnailVariant(Base):
+    __tablename__ = "image_variants"
+    __table_args__ = (
+        Index("ix_image_variants_imageID", "imageID", "width"),
+    )
+
+    variantID = Column(Integer, primary_key=True, autoincrement=True)
+    imageID = Column(Integer, ForeignKey("images.imageID", ondelete="CASCADE"), nullable=False)
+    width = Column(Integer, nullable=False)
+    format = Column(String(10), nullable=False)
+    externalURL = Column(String(200), nullable=False)
+    internalURL = Column(String(200), nullable=False)
+
+# Signed ACCOUNT tokens of the user issued before notBefore, a UNIX timestamp, are rejected. See signedtokens.py
+class TokenRevocation(Base):
+    __tablename__ = "token_revocations"
+
+    email = Column(String(100), primary_key=True)
+    notBefore = Column(Float(precision=53), nullable=False)
 
 class Token(Base):
     __tablename__ = "tokens"
+    __table_args__ = (
+        # Expired tokens, deleted in batches by tokenreaper.py
+        Index("ix_tokens_expires", "expires"),
+    )
 
     email = Column(String(100), ForeignKey("users.email", ondelete="CASCADE"), primary_key=True)
     type = Column(Enum(tokenType), nullable=False, primary_key=True)
@@ -59,6 +59,10 @@
 
 import re
 import math
+from functools import lru_cache
+
+# Installed from PIP. More information at https://numpy.org/
+import numpy
 
 # A separator used to break the code into two parts to aid memorability.
 SEPARATOR_ = '+'
@@ -131,7 +135,7 @@ MIN_TRIMMABLE_CODE_LEN_ = 6
 GRID_SIZE_DEGREES_ = 0.000125
 
 
-def isValid(code):
+def _isValid(code):
     """
     Determines if a code is valid.
     To be valid, all characters must be from the Open Location Code character
@@ -187,7 +191,7 @@ def isShort(code):
     character.
     """
     # Check it's valid.
-    if not isValid(code):
+    if not _isValid(code):
         return False
     # If there are less characters than expected before the SEPARATOR.
     sep = code.find(SEPARATOR_)
@@ -196,7 +200,7 @@ def isShort(code):
     return False
 
 
-def isFull(code):
+def _isFull(code):
     """
     Determines if a code is a valid full Open Location Code.
     Not all possible combinations of Open Location Code characters decode to
@@ -205,7 +209,7 @@ def isFull(code):
     character is present, it must be the first character. If the separator
     character is present, it must be after four characters.
     """
-    if not isValid(code):
+    if not _isValid(code):
         return False
     # If it's short, it's not full
     if isShort(code):
@@ -297,7 +301,7 @@ def encode(latitude, longitude, codeLength=PAIR_CODE_LENGTH_):
                                          codeLength) + SEPARATOR_
 
 
-def decode(code):
+def _decode(code):
     """
     Decodes an Open Location Code into the location coordinates.
     Returns a CodeArea object that includes the coordinates of the bounding
@@ -308,7 +312,7 @@ def decode(code):
       A CodeArea object that provides the latitude and longitude of two of the
       corners of the area, the center, and the length of the original code.
     """
-    if not isFull(code):
+    if not _isFull(code):
         raise ValueError(
             'Passed Open Location Code is not a valid full code - ' + str(code))
     # Strip out separator character (we've already established the code is
@@ -528,6 +532,9 @@ class CodeArea(object):
        code_length: The number of significant characters that were in the code.
            This excludes the separator.
     """
+    __slots__ = ('latitudeLo', 'longitudeLo', 'latitudeHi', 'longitudeHi',
+                 'codeLength', 'latitudeCenter', 'longitudeCenter')
+
     def __init__(self, latitudeLo, longitudeLo, latitudeHi, longitudeHi,
                  codeLength):
         self.latitudeLo = latitudeLo
@@ -548,4 +555,264 @@ class CodeArea(object):
         ])
 
     def latlng(self):
-        return [self.latitudeCenter, self.longitudeCenter]
\ No newline at end of file
+        return [self.latitudeCenter, self.longitudeCenter]
+
+
+# ==============================================================================
+# Cached validation and decoding. Not part of the upstream library.
+#
+# Places are validated and decoded by the same few codes over and over, so
+# isValid(), isFull() and decode() remember their most recent results in LRU
+# caches of DEFAULT_CACHE_SIZE_ entries each, resized with setCacheSize().
+# Cached CodeArea objects are shared between callers and must not be modified.
+
+DEFAULT_CACHE_SIZE_ = 10000
+
+_cachedIsValid = None
+_cachedIsFull = None
+_cachedDecode = None
+
+
+def setCacheSize(maxsize):
+    """
+     Replaces the caches with empty ones holding up to maxsize codes each.
+     A maxsize of 0 disables caching and None makes the caches unbounded.
+    """
+    global _cachedIsValid, _cachedIsFull, _cachedDecode
+    _cachedIsValid = lru_cache(maxsize)(_isValid)
+    _cachedIsFull = lru_cache(maxsize)(_isFull)
+    _cachedDecode = lru_cache(maxsize)(_decode)
+
+
+def cacheInfo():
+    """
+     Returns the hits, misses, maxsize and currsize of each cache, by function.
+    """
+    return {
+        'isValid': _cachedIsValid.cache_info()._asdict(),
+        'isFull': _cachedIsFull.cache_info()._asdict(),
+        'decode': _cachedDecode.cache_info()._asdict(),
+    }
+
+
+def isValid(code):
+    """
+     Determines if a code is valid. See _isValid().
+    """
+    return _cachedIsValid(code)
+
+
+def isFull(code):
+    """
+     Determines if a code is a valid full Open Location Code. See _isFull().
+    """
+    return _cachedIsFull(code)
+
+
+def decode(code):
+    """
+     Decodes an Open Location Code into a CodeArea. See _decode().
+    """
+    return _cachedDecode(code)
+
+
+setCacheSize(DEFAULT_CACHE_SIZE_)
+
+# ==============================================================================
+# Batch encoding and decoding. Not part of the upstream library.
+#
+# These work on whole NumPy arrays at once instead of one code at a time, for
+# backfilling or re-indexing many places. They use the same integer arithmetic
+# as encode() and decode(). encodeMany() returns exactly the codes encode()
+# does, and decodeMany() agrees with decode() to within 1e-13 degrees, as
+# NumPy rounds differently from the built in round().
+
+# Maps an ASCII byte to its digit value, or -1 for bytes outside the alphabet.
+_DIGIT_VALUES_ = numpy.full(256, -1, dtype=numpy.int64)
+for _i, _ch in enumerate(CODE_ALPHABET_):
+    _DIGIT_VALUES_[ord(_ch)] = _i
+_ALPHABET_BYTES_ = numpy.frombuffer(CODE_ALPHABET_.encode('ascii'), dtype=numpy.uint8)
+
+
+def _codeBytes(codes):
+    """
+     Converts codes to an upper case byte matrix with one row per code, padded
+     with zero bytes to at least MAX_DIGIT_COUNT_ + 1 columns.
+    """
+    codes = numpy.char.upper(numpy.asarray(codes, dtype=str))
+    try:
+        encoded = codes.astype('S')
+    except UnicodeEncodeError:
+        raise ValueError('Passed Open Location Codes are not all ASCII')
+    width = max(encoded.dtype.itemsize, MAX_DIGIT_COUNT_ + 1)
+    encoded = encoded.astype('S%d' % width)
+    return encoded.view(numpy.uint8).reshape(len(encoded), width)
+
+
+def isFullMany(codes):
+    """
+     Determines which of an array of codes are valid full Open Location Codes,
+     by the same rules as isFull().
+     Args:
+       codes: A sequence or array of code strings.
+     Returns:
+       A boolean array, True where the code is a valid full code.
+    """
+    chars = _codeBytes(codes)
+    length = (chars != 0).sum(axis=1)
+    isSeparator = chars == ord(SEPARATOR_)
+    isPadding = chars == ord(PADDING_CHARACTER_)
+    isDigit = _DIGIT_VALUES_[chars] >= 0
+    position = numpy.arange(chars.shape[1])
+
+    # Exactly one separator, after the eighth character, and only legal
+    # characters everywhere else. Never a single character after it.
+    valid = (isSeparator.sum(axis=1) == 1) & isSeparator[:, SEPARATOR_POSITION_]
+    valid &= ((chars == 0) | isSeparator | isPadding | isDigit).all(axis=1)
+    valid &= length - SEPARATOR_POSITION_ - 1 != 1
+
+    # Padding is a single group of an even number of characters, not at the
+    # start, running up to a separator that ends the code.
+    hasPadding = isPadding.any(axis=1)
+    pad = numpy.where(hasPadding, isPadding.argmax(axis=1), SEPARATOR_POSITION_)
+    inPadding = (position[None, :] >= pad[:, None]) & (position[None, :] < SEPARATOR_POSITION_)
+    valid &= ~hasPadding | (
+        (pad > 0) & (pad % 2 == 0) & (isPadding == inPadding).all(axis=1) &
+        (length == SEPARATOR_POSITION_ + 1))
+
+    # The first pair must not decode to a latitude >= 90 or longitude >= 180.
+    firstLatValue = _DIGIT_VALUES_[chars[:, 0]] * ENCODING_BASE_
+    firstLngValue = _DIGIT_VALUES_[chars[:, 1]] * ENCODING_BASE_
+    valid &= (firstLatValue < LATITUDE_MAX_ * 2) & (firstLngValue < LONGITUDE_MAX_ * 2)
+    return valid
+
+
+def decodeMany(codes):
+    """
+     Decodes an array of full Open Location Codes to the centers of their
+     areas. Equivalent to calling decode(code).latlng() for every code, up to
+     floating point rounding.
+     Args:
+       codes: A sequence or array of full code strings.
+     Returns:
+       A pair of float arrays, the center latitudes and center longitudes.
+     Raises:
+       ValueError: If any of the codes is not a valid full code.
+    """
+    chars = _codeBytes(codes)
+    if len(chars) == 0:
+        return numpy.empty(0), numpy.empty(0)
+    valid = isFullMany(codes)
+    if not valid.all():
+        raise ValueError(
+            'Passed Open Location Code is not a valid full code - ' +
+            str(numpy.asarray(codes)[~valid][0]))
+
+    # The digits are the eight characters before the separator, ending early
+    # at any padding, followed by those after it, up to MAX_DIGIT_COUNT_.
+    digits = numpy.concatenate(
+        (chars[:, :SEPARATOR_POSITION_],
+         chars[:, SEPARATOR_POSITION_ + 1:MAX_DIGIT_COUNT_ + 1]), axis=1)
+    values = _DIGIT_VALUES_[digits]
+    count = numpy.minimum((values >= 0).sum(axis=1), MAX_DIGIT_COUNT_)
+    values = numpy.maximum(values, 0)
+
+    # Decode the paired digits. Missing digits are zero and add nothing.
+    normalLat = numpy.full(len(chars), -LATITUDE_MAX_ * PAIR_PRECISION_, dtype=numpy.int64)
+    normalLng = numpy.full(len(chars), -LONGITUDE_MAX_ * PAIR_PRECISION_, dtype=numpy.int64)
+    pv = int(PAIR_FIRST_PLACE_VALUE_)
+    for i in range(0, PAIR_CODE_LENGTH_, 2):
+        normalLat += values[:, i] * pv
+        normalLng += values[:, i + 1] * pv
+        pv //= ENCODING_BASE_
+    pairs = numpy.minimum(count, PAIR_CODE_LENGTH_) // 2
+    latPrecision = ENCODING_BASE_**(PAIR_CODE_LENGTH_ // 2 - pairs) / PAIR_PRECISION_
+    lngPrecision = latPrecision
+
+    # Process any extra precision digits.
+    gridLat = numpy.zeros(len(chars), dtype=numpy.int64)
+    gridLng = numpy.zeros(len(chars), dtype=numpy.int64)
+    rowpv = GRID_LAT_FIRST_PLACE_VALUE_
+    colpv = GRID_LNG_FIRST_PLACE_VALUE_
+    for i in range(PAIR_CODE_LENGTH_, MAX_DIGIT_COUNT_):
+        gridLat += values[:, i] // GRID_COLUMNS_ * rowpv
+        gridLng += values[:, i] % GRID_COLUMNS_ * colpv
+        rowpv //= GRID_ROWS_
+        colpv //= GRID_COLUMNS_
+    grid = numpy.maximum(count - PAIR_CODE_LENGTH_, 0)
+    latPrecision = numpy.where(
+        grid > 0, GRID_ROWS_**(GRID_CODE_LENGTH_ - grid) / FINAL_LAT_PRECISION_, latPrecision)
+    lngPrecision = numpy.where(
+        grid > 0, GRID_COLUMNS_**(GRID_CODE_LENGTH_ - grid) / FINAL_LNG_PRECISION_, lngPrecision)
+
+    # Merge the values from the normal and extra precision parts of the code,
+    # rounding as decode() and CodeArea do.
+    lat = normalLat / PAIR_PRECISION_ + gridLat / FINAL_LAT_PRECISION_
+    lng = normalLng / PAIR_PRECISION_ + gridLng / FINAL_LNG_PRECISION_
+    latitudeLo, latitudeHi = numpy.round(lat, 14), numpy.round(lat + latPrecision, 14)
+    longitudeLo, longitudeHi = numpy.round(lng, 14), numpy.round(lng + lngPrecision, 14)
+    return (
+        numpy.minimum(latitudeLo + (latitudeHi - latitudeLo) / 2, LATITUDE_MAX_),
+        numpy.minimum(longitudeLo + (longitudeHi - longitudeLo) / 2, LONGITUDE_MAX_))
+
+
+def encodeMany(latitudes, longitudes, codeLength=PAIR_CODE_LENGTH_):
+    """
+     Encodes arrays of locations into Open Location Codes. Equivalent to
+     calling encode() for every pair of coordinates.
+     Args:
+       latitudes: Latitudes in signed decimal degrees. Will be clipped to the
+           range -90 to 90.
+       longitudes: Longitudes in signed decimal degrees. Will be normalised
+           to the range -180 to 180.
+       codeLength: The number of significant digits in every output code, not
+           including any separator characters.
+     Returns:
+       An array of code strings.
+    """
+    if codeLength < 2 or (codeLength < PAIR_CODE_LENGTH_ and
+                          codeLength % 2 == 1):
+        raise ValueError('Invalid Open Location Code length - ' +
+                         str(codeLength))
+    codeLength = min(codeLength, MAX_DIGIT_COUNT_)
+    # Ensure that latitude and longitude are valid.
+    latitudes = numpy.clip(numpy.asarray(latitudes, dtype=float), -LATITUDE_MAX_, LATITUDE_MAX_)
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    longitudes = numpy.where(
+        (longitudes < -LONGITUDE_MAX_) | (longitudes >= LONGITUDE_MAX_),
+        numpy.mod(longitudes + LONGITUDE_MAX_, 2 * LONGITUDE_MAX_) - LONGITUDE_MAX_,
+        longitudes)
+    latitudes = numpy.where(
+        latitudes == LATITUDE_MAX_,
+        latitudes - computeLatitudePrecision(codeLength), latitudes)
+
+    # The same integer conversion as encode(), including its rounding.
+    latVal = numpy.floor(numpy.round(
+        (latitudes + LATITUDE_MAX_) * FINAL_LAT_PRECISION_, 6)).astype(numpy.int64)
+    lngVal = numpy.floor(numpy.round(
+        (longitudes + LONGITUDE_MAX_) * FINAL_LNG_PRECISION_, 6)).astype(numpy.int64)
+
+    # Compute every digit and the separator, then cut them to codeLength.
+    chars = numpy.empty((len(latVal), MAX_DIGIT_COUNT_ + 1), dtype=numpy.uint8)
+    chars[:, SEPARATOR_POSITION_] = ord(SEPARATOR_)
+    for column in range(MAX_DIGIT_COUNT_, PAIR_CODE_LENGTH_, -1):
+        chars[:, column] = _ALPHABET_BYTES_[
+            latVal % GRID_ROWS_ * GRID_COLUMNS_ + lngVal % GRID_COLUMNS_]
+        latVal //= GRID_ROWS_
+        lngVal //= GRID_COLUMNS_
+    for i in range(PAIR_CODE_LENGTH_ - 2, -1, -2):
+        # Digits from the separator position on are shifted past it.
+        column = i if i < SEPARATOR_POSITION_ else i + 1
+        chars[:, column] = _ALPHABET_BYTES_[latVal % ENCODING_BASE_]
+        chars[:, column + 1] = _ALPHABET_BYTES_[lngVal % ENCODING_BASE_]
+        latVal //= ENCODING_BASE_
+        lngVal //= ENCODING_BASE_
+
+    if codeLength >= SEPARATOR_POSITION_:
+        chars = chars[:, :codeLength + 1]
+    else:
+        # Pad the code.
+        chars = chars[:, :SEPARATOR_POSITION_ + 1]
+        chars[:, codeLength:SEPARATOR_POSITION_] = ord(PADDING_CHARACTER_)
+    chars = numpy.ascontiguousarray(chars)
+    return chars.view('S%d' % chars.shape[1]).ravel().astype(str)
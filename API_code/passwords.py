@@ -0,0 +1,96 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (PASSWORD_HASH_WORKERS, PASSWORD_HASHER, SCRYPT_N_LOG2,
+                    SCRYPT_P, SCRYPT_R)
+
+# Password hashing. Hashes are stored as "$<hasher>$<parameters>$<salt>$<hash>", so every user's
+# salt and cost parameters travel with their hash and can be raised in config.py at any time.
+# Hashes made with older parameters, or by an older hasher, still verify and are replaced the
+# next time the user logs in. Hashes from before this module existed are bare SHA-256 hex digests.
+#
+# Key derivation is deliberately slow, so async code should await hash_async and verify_async,
+# which run it on a fixed number of threads. hashlib.scrypt releases the GIL while it works.
+
+_executor = None
+
+
+def _b64encode(data: bytes):
+    return base64.b64encode(data).decode().rstrip("=")
+
+def _b64decode(data: str):
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class ScryptHasher(object):
+    name = "scrypt"
+
+    def __init__(self, n_log2: int, r: int, p: int):
+        self.n_log2 = n_log2
+        self.r = r
+        self.p = p
+
+    def _derive(self, password: str, salt: bytes, n_log2: int, r: int, p: int):
+        n = 2 ** n_log2
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * r * n + 1024 * 1024, dklen=32)
+
+    def hash(self, password: str):
+        salt = os.urandom(16)
+        key = self._derive(password, salt, self.n_log2, self.r, self.p)
+        return f"${self.name}$ln={self.n_log2},r={self.r},p={self.p}${_b64encode(salt)}${_b64encode(key)}"
+
+    def verify(self, password: str, parameters: str, salt: str, key: str):
+        parameters = dict(item.split("=", 1) for item in parameters.split(","))
+        derived = self._derive(password, _b64decode(salt), int(parameters["ln"]), int(parameters["r"]), int(parameters["p"]))
+        return hmac.compare_digest(derived, _b64decode(key))
+
+    def parameters(self):
+        return f"ln={self.n_log2},r={self.r},p={self.p}"
+
+
+# Every hasher that can verify stored hashes, by the name in the hash. New hashes use PASSWORD_HASHER
+hashers = {
+    ScryptHasher.name: ScryptHasher(SCRYPT_N_LOG2, SCRYPT_R, SCRYPT_P),
+}
+
+def hash_password(password: str):
+    return hashers[PASSWORD_HASHER].hash(password)
+
+def verify_password(password: str, hashed: str):
+    if not hashed.startswith("$"):
+        legacy = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(legacy, hashed)
+
+    try:
+        _, name, parameters, salt, key = hashed.split("$")
+        return hashers[name].verify(password, parameters, salt, key)
+    except (KeyError, ValueError):
+        return False
+
+# True if the hash was not made by PASSWORD_HASHER with its current parameters
+def needs_rehash(hashed: str):
+    hasher = hashers[PASSWORD_HASHER]
+    return not hashed.startswith(f"${hasher.name}${hasher.parameters()}$")
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="passwords")
+    return _executor
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def hash_async(password: str):
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), hash_password, password)
+
+async def verify_async(password: str, hashed: str):
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), verify_password, password, hashed)
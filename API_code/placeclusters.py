@@ -0,0 +1,46 @@
+# Installed from PIP. More information at https://numpy.org/
+import numpy
+
+# Taken from https://github.com/google/open-location-code
+# License information can be found in openlocationcode.py
+from openlocationcode import decode, decodeMany, encodeMany
+
+# Computes the rows of the place_clusters table in bulk. Used both by the migration that creates the
+# table and by crud.rebuild_place_clusters, so it only takes plain rows and imports neither models nor crud.
+# As that migration runs it, the rows must keep matching the columns place_clusters was created with.
+
+
+# Returns the place_clusters rows of the given places, one per cell holding any of them at each level.
+# places are rows with plusCode, latitude, longitude, ratingSum and ratingCount. Places without stored
+# coordinates are placed by decoding their plus code
+def cluster_rows(places, levels):
+    rows = list()
+    if not places:
+        return rows
+
+    latitudes = numpy.array([place.latitude if place.latitude is not None else numpy.nan for place in places])
+    longitudes = numpy.array([place.longitude if place.longitude is not None else numpy.nan for place in places])
+    missing = numpy.isnan(latitudes)
+    if missing.any():
+        latitudes[missing], longitudes[missing] = decodeMany([place.plusCode for place, absent in zip(places, missing) if absent])
+    ratingSums = numpy.array([place.ratingSum for place in places], dtype=float)
+    ratingCounts = numpy.array([place.ratingCount for place in places], dtype=float)
+
+    for level in levels:
+        codes, cell = numpy.unique(encodeMany(latitudes, longitudes, level), return_inverse=True)
+        placeCounts = numpy.bincount(cell)
+        totals = [numpy.bincount(cell, weights) for weights in (ratingSums, ratingCounts, latitudes, longitudes)]
+        for index, code in enumerate(codes.tolist()):
+            area = decode(code)
+            rows.append(dict(
+                level=level,
+                cell=code[:level],
+                south=area.latitudeLo,
+                west=area.longitudeLo,
+                placeCount=int(placeCounts[index]),
+                ratingSum=int(round(totals[0][index])),
+                ratingCount=int(round(totals[1][index])),
+                latitudeSum=float(totals[2][index]),
+                longitudeSum=float(totals[3][index])
+            ))
+    return rows
@@ -0,0 +1,42 @@
+from time import monotonic
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import models
+from config import INDEX_REFRESH_SECONDS
+
+# The in-process place indexes are only told about the writes made by their own process. When several
+# API processes share the database, each index keeps a PlaceStamp and reloads itself whenever the
+# places table changed since it was loaded. Every write to a place bumps its version and lastModified
+# and deletions lower the count, so comparing the three catches changes made by any process.
+
+
+# Returns (count, sum of versions, latest lastModified) over every place, read from ix_places_verified_version
+def read(db: Session):
+    row = db.query(
+        func.count(models.Place.placeID),
+        func.coalesce(func.sum(models.Place.version), 0),
+        func.max(models.Place.lastModified)
+    ).one()
+    return (int(row[0]), int(row[1]), row[2])
+
+
+# Remembers the stamp an index was loaded at. The database is read at most every INDEX_REFRESH_SECONDS,
+# so writes made by other processes show up within that time. Callers hold the index's lock
+class PlaceStamp(object):
+    def __init__(self):
+        self.loaded = None
+        self.checked = None
+
+    # Returns the current stamp if the index has to be reloaded, otherwise None
+    def changed(self, db: Session):
+        now = monotonic()
+        if self.loaded is not None and now - self.checked < INDEX_REFRESH_SECONDS:
+            return None
+        self.checked = now
+        stamp = read(db)
+        if stamp == self.loaded:
+            return None
+        return stamp
@@ -0,0 +1,147 @@
+import threading
+from time import monotonic
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from config import (DB_POOL_MAX_OVERFLOW, DB_POOL_PING_IDLE_SECONDS,
+                    DB_POOL_PRE_PING, DB_POOL_RECYCLE_SECONDS, DB_POOL_SIZE,
+                    DB_POOL_TIMEOUT_SECONDS)
+
+# Database connection pools, sized from config.py, that count how long checkouts wait for a
+# connection. Each API process has its own pool, so the database sees up to
+# (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW) connections per process. Plain def endpoints run on
+# FastAPI's threadpool (40 threads by default), so a pool smaller than that makes requests queue
+# for a connection under load, which shows up as waits in /debug/metrics.
+#
+# DB_POOL_PRE_PING decides when a connection is tested before it is handed out:
+#   "always" pings on every checkout, costing a round trip per request
+#   "idle"   pings only connections unused for DB_POOL_PING_IDLE_SECONDS, which are the ones the
+#            server or a firewall may have dropped
+#   "never"  relies on DB_POOL_RECYCLE_SECONDS alone
+# A failed ping discards the connection and the pool opens a new one.
+
+
+class PoolStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.pings = 0
+        self.ping_failures = 0
+
+    # Checkouts that took under a millisecond were served straight from the pool and are not counted as waits
+    def record_checkout(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            if seconds >= 0.001:
+                self.waits += 1
+                self.wait_seconds += seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_ping(self, failed: bool):
+        with self._lock:
+            self.pings += 1
+            if failed:
+                self.ping_failures += 1
+
+
+class _InstrumentedPool(object):
+    # Times every checkout, including opening a new connection when the pool grows
+    def _do_get(self):
+        started = monotonic()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record_checkout(monotonic() - started)
+        return connection
+
+    # The pool is replaced when the engine is disposed or sees a disconnect. Keep counting into the same stats
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+class InstrumentedAsyncQueuePool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+
+# Keyword arguments for create_engine or create_async_engine
+def engine_options(asynchronous: bool = False):
+    if DB_POOL_PRE_PING not in ("always", "idle", "never"):
+        raise ValueError(f"DB_POOL_PRE_PING must be always, idle or never, not {DB_POOL_PRE_PING!r}")
+    return {
+        "poolclass": InstrumentedAsyncQueuePool if asynchronous else InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_POOL_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT_SECONDS,
+        "pool_recycle": DB_POOL_RECYCLE_SECONDS,
+        "pool_pre_ping": DB_POOL_PRE_PING == "always",
+    }
+
+# Adds the "idle" ping to an engine made with engine_options
+def install_idle_ping(engine: Engine):
+    if DB_POOL_PRE_PING != "idle":
+        return
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info["checkedIn"] = monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_in = connection_record.info.get("checkedIn")
+        if checked_in is None or monotonic() - checked_in < DB_POOL_PING_IDLE_SECONDS:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception:
+            engine.pool.stats.record_ping(failed=True)
+            # Makes the pool discard this connection and check out another
+            raise exc.DisconnectionError()
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        engine.pool.stats.record_ping(failed=False)
+
+def metrics(engine: Engine):
+    pool = engine.pool
+    stats = pool.stats
+    with stats._lock:
+        return {
+            "size": pool.size(),
+            "maxOverflow": DB_POOL_MAX_OVERFLOW,
+            "checkedOut": pool.checkedout(),
+            "checkedIn": pool.checkedin(),
+            # Connections open beyond size. Negative while the pool has not yet opened size connections
+            "overflow": pool.overflow(),
+            "checkouts": stats.checkouts,
+            "waits": stats.waits,
+            "waitSeconds": round(stats.wait_seconds, 3),
+            "maxWaitSeconds": round(stats.max_wait_seconds, 3),
+            "timeouts": stats.timeouts,
+            "pings": stats.pings,
+            "pingFailures": stats.ping_failures,
+        }
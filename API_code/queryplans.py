@@ -0,0 +1,120 @@
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import crud
+import placestamp
+import models
+import spatialindex
+from schemas import placeOrder, ratingOrder, tokenType, visibility
+
+# Checks that the queries crud sends to the database are served by an index. The read paths
+# of crud are called against the configured database with real keys taken from it, every
+# SELECT they issue is recorded, and each one is run again under EXPLAIN. A plan that reads
+# a whole table is reported as a failure. Results are only meaningful on a database holding
+# a representative amount of data, as planners happily scan tables of a few rows.
+#
+# spatialindex and searchindex deliberately read every place once when they load, so the
+# distance listing and search are not part of the check. spatialindex is loaded before
+# recording starts, as the viewport and radius queries load it first.
+
+
+# Samples of each key crud looks rows up by, or placeholders if the table is empty
+def _samples(db: Session):
+    user = db.query(models.User).first() or models.User(email="nobody@example.com", username="nobody")
+    place = db.query(models.Place).first()
+    image = db.query(models.Thumbnail).first()
+    comment = db.query(models.Comment).first()
+    token = db.query(models.Token).first()
+    return {
+        "user": user,
+        "placeID": place.placeID if place is not None else 0,
+        "imageID": image.imageID if image is not None else 0,
+        "ratingID": comment.ratingID if comment is not None else 0,
+        "token": token.token if token is not None else "",
+    }
+
+# (name, call) of every read path to check
+CHECKS = [
+    ("get_user", lambda db, s: crud.get_user(db, s["user"].email)),
+    ("get_user_from_username", lambda db, s: crud.get_user_from_username(db, s["user"].username)),
+    ("get_user_info", lambda db, s: crud.get_user_info(db, s["user"].email)),
+    ("get_users", lambda db, s: crud.get_users(db, limit=10, cursor=crud.encode_cursor("users", s["user"].email))),
+    ("get_place", lambda db, s: crud.get_place(db, s["placeID"])),
+    ("get_place_version", lambda db, s: crud.get_place_version(db, s["placeID"])),
+    ("get_places_version", lambda db, s: crud.get_places_version(db, visibility.VERIFIED)),
+    ("placestamp.read", lambda db, s: placestamp.read(db)),
+    ("get_places_by_popularity", lambda db, s: crud.get_places_by_popularity(db, limit=10, visibility=visibility.VERIFIED)),
+    ("get_places_by_popularity (cursor)", lambda db, s: crud.get_places_by_popularity(db, limit=10, visibility=visibility.UNVERIFIED, cursor=crud.encode_cursor("popularity", 5, 0))),
+    ("get_place_summaries", lambda db, s: crud.get_place_summaries(db, placeOrder.POPULARITY, limit=10, visibility=visibility.VERIFIED)),
+    ("get_places_within", lambda db, s: crud.get_places_within(db, 39, -85, 40, -84, limit=10, visibility=visibility.VERIFIED)),
+    ("get_places_within (clusters)", lambda db, s: crud.get_places_within(db, -60, -120, 60, 120, limit=0, visibility=visibility.VERIFIED)),
+    ("get_place_clusters", lambda db, s: crud.get_place_clusters(db, 4, 39, -85, 42, -80)),
+    ("get_places_near", lambda db, s: crud.get_places_near(db, 39.5, -84.7, 100, limit=10, visibility=visibility.VERIFIED)),
+    ("get_places_from_user", lambda db, s: crud.get_places_from_user(db, s["user"])),
+    ("get_thumbnail_urls", lambda db, s: crud.get_thumbnail_urls(db, s["placeID"])),
+    ("get_thumbnails_from_place", lambda db, s: crud.get_thumbnails_from_place(db, s["placeID"], False)),
+    ("get_thumbnails_from_user", lambda db, s: crud.get_thumbnails_from_user(db, s["user"])),
+    ("get_thumbnail", lambda db, s: crud.get_thumbnail(db, s["imageID"])),
+    ("get_unverified_thumbnails", lambda db, s: crud.get_unverified_thumbnails(db, limit=10, cursor=crud.encode_cursor("images", 0))),
+    ("get_place_ratings", lambda db, s: crud.get_place_ratings(db, s["placeID"], ratingOrder.NEWEST, 10)),
+    ("get_place_ratings (highest)", lambda db, s: crud.get_place_ratings(db, s["placeID"], ratingOrder.HIGHEST, 10, crud.encode_cursor("ratings-Highest", s["placeID"], 3, 0))),
+    ("get_place_ratings (lowest)", lambda db, s: crud.get_place_ratings(db, s["placeID"], ratingOrder.LOWEST, 10, crud.encode_cursor("ratings-Lowest", s["placeID"], 3, 0))),
+    ("get_rating", lambda db, s: crud.get_rating(db, s["ratingID"])),
+    ("get_user_ratings", lambda db, s: crud.get_user_ratings(db, s["user"])),
+    ("get_token_by_user", lambda db, s: crud.get_token_by_user(db, s["user"].email, tokenType.ACCOUNT)),
+    ("get_token_by_token", lambda db, s: crud.get_token_by_token(db, s["token"])),
+]
+
+# Returns a list of problems with a plan, empty if every table in it is read through an index.
+# Reading the rows of a subquery is fine, as long as the subquery itself used an index
+def _problems(dialect: str, plan: list):
+    problems = list()
+    subqueries = set()
+    for row in plan:
+        row = dict(row._mapping)
+        if dialect == "mysql":
+            # Derived tables are listed as <derivedN>
+            if row["type"] == "ALL" and not (row["table"] or "").startswith("<"):
+                problems.append(f"full scan of {row['table']}")
+        elif dialect == "sqlite":
+            detail = row["detail"]
+            for prefix in ("CO-ROUTINE ", "MATERIALIZE "):
+                if detail.startswith(prefix):
+                    subqueries.add(detail[len(prefix):])
+            if detail.startswith("SCAN ") and " USING " not in detail and "CONSTANT ROW" not in detail:
+                if detail[len("SCAN "):] not in subqueries:
+                    problems.append(detail)
+    return problems
+
+# Runs every check. Returns a list of (name, statement, problems) for each recorded SELECT
+def explain(engine: Engine):
+    if engine.dialect.name not in ("mysql", "sqlite"):
+        raise ValueError(f"Query plans of {engine.dialect.name} databases are not supported")
+    explain_prefix = "EXPLAIN " if engine.dialect.name == "mysql" else "EXPLAIN QUERY PLAN "
+
+    recorded = list()
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            recorded.append((statement, parameters))
+
+    results = list()
+    db = Session(bind=engine)
+    try:
+        samples = _samples(db)
+        spatialindex.ensure_loaded(db)
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            for name, check in CHECKS:
+                del recorded[:]
+                check(db, samples)
+                for statement, parameters in list(recorded):
+                    plan = db.connection().exec_driver_sql(explain_prefix + statement, parameters).all()
+                    results.append((name, statement, _problems(engine.dialect.name, plan)))
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+    finally:
+        db.rollback()
+        db.close()
+    return results
@@ -1,6 +1,6 @@
 import enum
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -19,6 +19,11 @@ class placeOrder(str, enum.Enum):
     POPULARITY = "Popularity"
     DISTANCE = "Distance"
 
+class ratingOrder(str, enum.Enum):
+    NEWEST = "Newest"
+    HIGHEST = "Highest"
+    LOWEST = "Lowest"
+
 class visibility(int, enum.Enum):
     ALL = -1
     VERIFIED = 1
@@ -46,12 +51,22 @@ class PatchRating(BaseModel):
     class Config:
         orm_mode=True
 
+class ThumbnailVariant(BaseModel):
+    width: int
+    format: str
+    externalURL: str
+
+    class Config:
+        orm_mode=True
+
 class Thumbnail(BaseModel):
     imageID: int
     uploader: str
     placeID: int
     externalURL: str
     uploadDate: datetime
+    variants: Optional[List[ThumbnailVariant]]
+    srcset: Optional[str]
 
     class Config:
         orm_mode=True
@@ -79,16 +94,58 @@ class PatchPlace(BaseModel):
     class Config:
         orm_mode=True
 
+class PlaceStats(BaseModel):
+    count: int
+    # Exact average, or None without ratings
+    mean: Optional[float]
+    # Confidence weighted average that popularity listings are ordered by
+    score: float
+    # Number of ratings of each star value, 1 to 5
+    histogram: Dict[int, int]
+
 class GetPlace(SetPlace):
     placeID: int
     posterID: str
     rating: float
     thumbnails: Optional[List[Thumbnail]]
+    # Only the newest comments. commentCount is the total, the rest are paged through /place/{placeID}/ratings
     comments: Optional[List[GetRating]]
+    commentCount: int = 0
+    stats: Optional[PlaceStats]
 
 class InternalPlace(GetPlace):
     isvisible: bool
 
+# What a map or list view needs to show a place. coverImage is the first verified thumbnail, if there is one
+class PlaceSummary(BaseModel):
+    placeID: int
+    friendlyName: str
+    plusCode: str
+    rating: float
+    coverImage: Optional[str]
+
+# A place on a map. distance is in kilometres from the requested position, and only set by /places/near
+class PlaceMarker(PlaceSummary):
+    latitude: float
+    longitude: float
+    distance: Optional[float]
+
+# Places grouped by the plus code cell they are in. cell is the cell's padded code, e.g. 86FR0000+
+class PlaceCluster(BaseModel):
+    cell: str
+    count: int
+    # Average position of the places in the cell
+    latitude: float
+    longitude: float
+    # Average of every rating of the places in the cell, rounded to one decimal, or -1 when none of them are rated
+    rating: float
+
+# Either the places themselves, or clusters of them when there are too many to list
+class PlacesInArea(BaseModel):
+    total: int
+    places: Optional[List[PlaceMarker]]
+    clusters: Optional[List[PlaceCluster]]
+
 class SearchPlace(BaseModel):
     placeID: int
     friendlyName: str
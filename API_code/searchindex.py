@@ -0,0 +1,100 @@
+import heapq
+import threading
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy.orm import Session
+
+import models
+from placestamp import PlaceStamp
+
+# In-process n-gram index over the names of verified places, used for type-ahead search.
+# Every 1, 2 and 3 character substring of a lowercased name maps to the places containing it,
+# so queries of up to three characters are a single lookup and longer queries intersect the
+# postings of their trigrams before confirming the match. Like spatialindex, it is loaded from
+# the database on first use and kept current by crud as places change. Changes made by other
+# API processes are picked up by reloading it when the places table's stamp changes.
+
+MAX_GRAM = 3
+
+_lock = threading.Lock()
+_places = dict()
+_grams = dict()
+_loaded = False
+_stamp = PlaceStamp()
+
+
+def _grams_of(name: str):
+    grams = set()
+    for n in range(1, MAX_GRAM + 1):
+        for i in range(len(name) - n + 1):
+            grams.add(name[i:i + n])
+    return grams
+
+def _add(placeID: int, name: str, rating: float):
+    lowered = name.lower()
+    _places[placeID] = (name, lowered, rating)
+    for gram in _grams_of(lowered):
+        _grams.setdefault(gram, set()).add(placeID)
+
+def _remove(placeID: int):
+    place = _places.pop(placeID, None)
+    if place is None:
+        return
+    for gram in _grams_of(place[1]):
+        postings = _grams.get(gram)
+        if postings is not None:
+            postings.discard(placeID)
+            if not postings:
+                del _grams[gram]
+
+def _load(db: Session):
+    global _loaded
+    _places.clear()
+    _grams.clear()
+    rows = db.query(models.Place).with_entities(
+        models.Place.placeID,
+        models.Place.friendlyName,
+        models.Place.rating
+    ).filter(models.Place.verified == True).all()
+
+    for row in rows:
+        _add(row.placeID, row.friendlyName, row.rating)
+    _loaded = True
+
+# Indexes a place if it is verified and removes it otherwise
+def update(placeID: int, name: str, rating: float, verified: bool):
+    with _lock:
+        if not _loaded:
+            return
+        _remove(placeID)
+        if verified:
+            _add(placeID, name, rating)
+
+def set_rating(placeID: int, rating: float):
+    with _lock:
+        place = _places.get(placeID)
+        if place is not None:
+            _places[placeID] = (place[0], place[1], rating)
+
+def remove(placeID: int):
+    with _lock:
+        _remove(placeID)
+
+# Returns (placeID, friendlyName) of up to limit verified places whose name contains query, best rated first
+def search(db: Session, query: str, limit: int):
+    query = query.lower()
+    with _lock:
+        stamp = _stamp.changed(db)
+        if stamp is not None:
+            _load(db)
+            _stamp.loaded = stamp
+
+        if len(query) <= MAX_GRAM:
+            matches = _grams.get(query, set())
+        else:
+            postings = sorted((_grams.get(query[i:i + MAX_GRAM], set()) for i in range(len(query) - MAX_GRAM + 1)), key=len)
+            matches = set.intersection(*postings)
+            matches = [placeID for placeID in matches if query in _places[placeID][1]]
+
+        best = heapq.nsmallest(limit, matches, key=lambda placeID: (-_places[placeID][2], placeID))
+        return [(placeID, _places[placeID][0]) for placeID in best]
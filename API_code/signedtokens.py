@@ -0,0 +1,135 @@
+import base64
+import hashlib
+import hmac
+import json
+import math
+import secrets
+import threading
+from datetime import datetime
+from time import monotonic, time
+
+from fastapi import HTTPException, status
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy.orm import Session
+
+import models
+import secret_config
+from config import (SIGNED_TOKEN_MINUTES, TOKEN_MODE,
+                    TOKEN_REVOCATION_REFRESH_SECONDS, TOKEN_SIGNING_KEY_ID)
+from schemas import InternalUser, accessLevel
+
+# ACCOUNT tokens that validate without a database lookup, used when TOKEN_MODE is "signed".
+# Tokens are HS256 JWTs carrying the user's email, username, access level and verification
+# state, signed with the key TOKEN_SIGNING_KEY_ID from TOKEN_SIGNING_KEYS in secret_config.py.
+# Every key in TOKEN_SIGNING_KEYS is accepted, so keys are rotated by adding a new one, making
+# it the signing key, and removing the old one once SIGNED_TOKEN_MINUTES have passed.
+#
+# Tokens cannot be recalled once issued, so a user is signed out by recording a notBefore time
+# in the token_revocations table: any of their tokens issued earlier is rejected. Every API
+# process keeps the whole (small) table in memory and rereads it every
+# TOKEN_REVOCATION_REFRESH_SECONDS, as rows older than a token's lifetime are deleted.
+
+_lock = threading.Lock()
+_not_before = dict()
+_loaded_at = None
+
+
+def _b64encode(data: bytes):
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def _b64decode(data: str):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _keys():
+    return getattr(secret_config, "TOKEN_SIGNING_KEYS", dict())
+
+def _sign(key: str, message: bytes):
+    return hmac.new(_b64decode(key), message, hashlib.sha256).digest()
+
+# A new random signing key, to be added to TOKEN_SIGNING_KEYS
+def generate_key():
+    return _b64encode(secrets.token_bytes(32))
+
+# Signed tokens are three dot separated parts, which random database tokens never contain
+def is_signed(token: str):
+    return token.count(".") == 2
+
+def issue(user: models.User):
+    key = _keys().get(TOKEN_SIGNING_KEY_ID)
+    if key is None:
+        raise RuntimeError(f"TOKEN_SIGNING_KEYS in secret_config.py has no key {TOKEN_SIGNING_KEY_ID!r}")
+
+    # Milliseconds, rounded up so a token issued right after a revocation is never dated before it
+    issued = math.ceil(time() * 1000) / 1000
+    header = {"alg": "HS256", "typ": "JWT", "kid": TOKEN_SIGNING_KEY_ID}
+    claims = {
+        "sub": user.email,
+        "name": user.username,
+        "lvl": user.accessLevel.value,
+        "ver": user.verified,
+        "crt": user.accountCreated.timestamp() if user.accountCreated is not None else None,
+        "iat": issued,
+        "exp": int(issued) + SIGNED_TOKEN_MINUTES * 60,
+    }
+    signing_input = _b64encode(json.dumps(header, separators=(",", ":")).encode()) + "." + _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return signing_input + "." + _b64encode(_sign(key, signing_input.encode()))
+
+# Returns the user a token was issued to, or raises the same errors as database tokens
+def decode(db: Session, token: str):
+    try:
+        header, claims, signature = token.split(".")
+        kid = json.loads(_b64decode(header))["kid"]
+        key = _keys()[kid]
+        if not hmac.compare_digest(_sign(key, f"{header}.{claims}".encode()), _b64decode(signature)):
+            raise ValueError("Bad signature")
+        claims = json.loads(_b64decode(claims))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad token")
+
+    if claims["exp"] < time():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Token expired")
+    not_before = get_not_before(db, claims["sub"])
+    if not_before is not None and claims["iat"] < not_before:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad token")
+
+    return InternalUser(
+        username=claims["name"],
+        email=claims["sub"],
+        verified=claims["ver"],
+        accessLevel=accessLevel(claims["lvl"]),
+        accountCreated=datetime.fromtimestamp(claims["crt"]) if claims["crt"] is not None else None
+    )
+
+# =============================================================================== REVOCATION
+
+def _refresh(db: Session):
+    global _loaded_at
+    cutoff = time() - SIGNED_TOKEN_MINUTES * 60
+    db.query(models.TokenRevocation).filter(models.TokenRevocation.notBefore < cutoff).delete(synchronize_session=False)
+    db.commit()
+    rows = db.query(models.TokenRevocation).all()
+    with _lock:
+        _not_before.clear()
+        _not_before.update({row.email: row.notBefore for row in rows})
+        _loaded_at = monotonic()
+
+# Returns the time before which the user's tokens are rejected, or None
+def get_not_before(db: Session, email: str):
+    if _loaded_at is None or monotonic() - _loaded_at > TOKEN_REVOCATION_REFRESH_SECONDS:
+        _refresh(db)
+    with _lock:
+        return _not_before.get(email)
+
+# Rejects every token issued to the user until now
+def revoke(db: Session, email: str):
+    now = time()
+    db.merge(models.TokenRevocation(email=email, notBefore=now))
+    db.commit()
+    with _lock:
+        _not_before[email] = now
+
+# Called at startup, so misconfigured signing keys fail there rather than at the first login
+def check_configuration():
+    if TOKEN_MODE == "signed" and TOKEN_SIGNING_KEY_ID not in _keys():
+        raise RuntimeError(f"TOKEN_MODE is signed but TOKEN_SIGNING_KEYS in secret_config.py has no key {TOKEN_SIGNING_KEY_ID!r}")
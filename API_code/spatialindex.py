@@ -0,0 +1,200 @@
+import heapq
+import threading
+from math import cos, pi, sin
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy.orm import Session
+
+import models
+from placestamp import PlaceStamp
+
+# Taken from https://github.com/google/open-location-code
+# License information can be found in openlocationcode.py
+from openlocationcode import decodeMany
+
+# In-process KD-tree over every place's stored coordinates. Points are kept as
+# 3D unit vectors so that straight-line (chord) distance orders places exactly
+# like great-circle distance does, without any special casing for the poles or
+# the antimeridian. The tree is loaded from the database the first time it is
+# used and rebuilt lazily whenever a place is added, moved, verified or deleted.
+# It is reloaded when the places table's stamp shows another API process changed it.
+
+_lock = threading.Lock()
+_points = dict()
+_tree = None
+_loaded = False
+_dirty = True
+_stamp = PlaceStamp()
+
+
+# Each node also stores the bounding box of its subtree, so whole subtrees can be skipped when they are
+# either farther than the current k-th candidate or entirely before a pagination cursor
+class _Node(object):
+    __slots__ = ("point", "placeID", "verified", "left", "right", "lo", "hi")
+
+    def __init__(self, point, placeID, verified, left, right):
+        self.point = point
+        self.placeID = placeID
+        self.verified = verified
+        self.left = left
+        self.right = right
+        children = [child for child in (left, right) if child is not None]
+        self.lo = tuple(min([point[i]] + [child.lo[i] for child in children]) for i in range(3))
+        self.hi = tuple(max([point[i]] + [child.hi[i] for child in children]) for i in range(3))
+
+    # Smallest and largest squared distance from target to any point in the subtree
+    def bounds(self, target):
+        nearest = 0
+        farthest = 0
+        for i in range(3):
+            below = self.lo[i] - target[i]
+            above = target[i] - self.hi[i]
+            if below > 0:
+                nearest += below*below
+            elif above > 0:
+                nearest += above*above
+            farthest += max(below*below, above*above)
+        return nearest, farthest
+
+
+# Converts a latitude and longitude in degrees to a point on the unit sphere
+def to_point(latitude: float, longitude: float):
+    p = pi/180
+    lat = latitude * p
+    lon = longitude * p
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+def _build(items, depth: int = 0):
+    if not items:
+        return None
+    axis = depth % 3
+    items.sort(key=lambda item: item[1][0][axis])
+    median = len(items) // 2
+    placeID, (point, verified) = items[median]
+    return _Node(
+        point,
+        placeID,
+        verified,
+        _build(items[:median], depth + 1),
+        _build(items[median + 1:], depth + 1)
+    )
+
+def _rebuild():
+    global _tree, _dirty
+    _tree = _build(list(_points.items()))
+    _dirty = False
+
+# Loads every place's coordinates, decoding and storing them for rows written before coordinates were persisted
+def _load(db: Session):
+    global _loaded, _dirty
+    _points.clear()
+    rows = db.query(models.Place).with_entities(
+        models.Place.placeID,
+        models.Place.plusCode,
+        models.Place.latitude,
+        models.Place.longitude,
+        models.Place.verified
+    ).all()
+
+    # Missing coordinates are decoded in one batch
+    missing = [row for row in rows if row.latitude is None or row.longitude is None]
+    decoded = dict()
+    if missing:
+        latitudes, longitudes = decodeMany([row.plusCode for row in missing])
+        decoded = {row.placeID: (float(latitude), float(longitude)) for row, latitude, longitude in zip(missing, latitudes, longitudes)}
+
+    for row in rows:
+        latitude, longitude = decoded.get(row.placeID, (row.latitude, row.longitude))
+        _points[row.placeID] = (to_point(latitude, longitude), row.verified)
+
+    if missing:
+        db.bulk_update_mappings(models.Place, [
+            {"placeID": placeID, "latitude": latitude, "longitude": longitude}
+            for placeID, (latitude, longitude) in decoded.items()
+        ])
+        db.commit()
+    _loaded = True
+    _dirty = True
+
+# Reloads every place if the places table changed since the last load, including changes by other processes
+def _refresh(db: Session):
+    stamp = _stamp.changed(db)
+    if stamp is not None:
+        _load(db)
+        _stamp.loaded = stamp
+
+# Makes sure every place's coordinates are stored, for queries that read them from the database
+def ensure_loaded(db: Session):
+    with _lock:
+        if not _loaded:
+            _refresh(db)
+
+def _ensure_ready(db: Session):
+    _refresh(db)
+    if _dirty:
+        _rebuild()
+
+# Adds a place to the index or moves it if it is already present
+def upsert(placeID: int, latitude: float, longitude: float, verified: bool):
+    global _dirty
+    with _lock:
+        if _loaded:
+            _points[placeID] = (to_point(latitude, longitude), verified)
+            _dirty = True
+
+def set_verified(placeID: int, verified: bool):
+    global _dirty
+    with _lock:
+        if placeID in _points:
+            _points[placeID] = (_points[placeID][0], verified)
+            _dirty = True
+
+def remove(placeID: int):
+    global _dirty
+    with _lock:
+        if _points.pop(placeID, None) is not None:
+            _dirty = True
+
+# Returns (placeID, distance) of the k places closest to the given position, nearest first. Distances are
+# squared chord lengths on the unit sphere, only meaningful for comparison and as a cursor. Places at the
+# same distance are ordered by placeID so that pages never overlap. verified filters on the place's
+# visibility, or is None for all places. after is the (distance, placeID) of the last place of the
+# previous page, to continue from it
+def nearest(db: Session, latitude: float, longitude: float, k: int, verified: bool = None, after: tuple = None):
+    with _lock:
+        _ensure_ready(db)
+        tree = _tree
+
+    if k <= 0 or tree is None:
+        return list()
+
+    target = to_point(latitude, longitude)
+    # Max-heap of the best k candidates so far, stored as (-distance, -placeID)
+    best = list()
+
+    def visit(node):
+        nearest, farthest = node.bounds(target)
+        if len(best) == k and nearest > -best[0][0]:
+            return
+        if after is not None and farthest < after[0]:
+            return
+
+        point = node.point
+        dx = point[0] - target[0]
+        dy = point[1] - target[1]
+        dz = point[2] - target[2]
+        dist = dx*dx + dy*dy + dz*dz
+        if (verified is None or node.verified == verified) and (after is None or (dist, node.placeID) > after):
+            candidate = (-dist, -node.placeID)
+            if len(best) < k:
+                heapq.heappush(best, candidate)
+            elif candidate > best[0]:
+                heapq.heapreplace(best, candidate)
+
+        children = [child for child in (node.left, node.right) if child is not None]
+        children.sort(key=lambda child: child.bounds(target)[0])
+        for child in children:
+            visit(child)
+
+    visit(tree)
+    return [(-placeID, -dist) for dist, placeID in sorted(best, reverse=True)]
@@ -0,0 +1,131 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+
+from fastapi import HTTPException, status
+
+# Installed from PIP. More information at https://www.sqlalchemy.org/
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+
+import models
+from config import (ACCESS_TOKEN_DELTA_MINUTES, TOKEN_CACHE_MAX_ENTRIES,
+                    TOKEN_CACHE_TTL_SECONDS, TOKEN_FLUSH_INTERVAL_SECONDS)
+from schemas import InternalUser, tokenType
+
+# Resolves ACCOUNT tokens to users without writing to the database on every request. A hit
+# only checks that the token row still exists and that its user's name, verification and
+# access level are unchanged, since another API process may have signed it out or changed
+# them. The full lookup is repeated every TOKEN_CACHE_TTL_SECONDS. Sliding expiry is applied
+# in memory and written back in one batch every TOKEN_FLUSH_INTERVAL_SECONDS, which must stay
+# below the TTL so a revalidation never reads an expiry older than the one held here.
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_tokens_by_email = dict()
+_pending = dict()
+_last_flush = monotonic()
+
+
+class _Entry(object):
+    __slots__ = ("user", "expires", "cached")
+
+    def __init__(self, user: InternalUser, expires: datetime):
+        self.user = user
+        self.expires = expires
+        self.cached = monotonic()
+
+
+def _drop(token: str):
+    entry = _entries.pop(token, None)
+    if entry is not None and _tokens_by_email.get(entry.user.email) == token:
+        del _tokens_by_email[entry.user.email]
+
+# Reads the parts of a user that can change while their token lives, or None if the token is gone.
+# A single lookup by token joined to the user's primary key
+def _current(db: Session, token: str):
+    return db.query(models.User).join(models.Token, models.Token.email == models.User.email).with_entities(
+        models.User.username,
+        models.User.verified,
+        models.User.accessLevel
+    ).filter(models.Token.token == token, models.Token.type == tokenType.ACCOUNT).first()
+
+# Returns the cached user for a token and slides its expiry, or None if it must be looked up. The token row
+# is checked on every hit, so a token signed out, reset or deleted by another API process, or a user whose
+# name, verification or access level another process changed, is never served from here
+def get(db: Session, token: str):
+    with _lock:
+        entry = _entries.get(token)
+        if entry is None:
+            return None
+        if monotonic() - entry.cached > TOKEN_CACHE_TTL_SECONDS:
+            _drop(token)
+            return None
+        user = entry.user
+
+    current = _current(db, token)
+    if current is None or (current.username, current.verified, current.accessLevel) != (user.username, user.verified, user.accessLevel):
+        invalidate_user(user.email)
+        return None
+
+    with _lock:
+        if _entries.get(token) is not entry:
+            return None
+
+        now = datetime.now()
+        if entry.expires < now:
+            _drop(token)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Token expired")
+
+        entry.expires = now + timedelta(minutes=ACCESS_TOKEN_DELTA_MINUTES)
+        _pending[entry.user.email] = (token, entry.expires)
+        _entries.move_to_end(token)
+        return entry.user
+
+# Caches a freshly validated token, extending its expiry as a database refresh would
+def put(token: str, user: InternalUser):
+    with _lock:
+        old_token = _tokens_by_email.get(user.email)
+        if old_token is not None:
+            _drop(old_token)
+
+        entry = _Entry(user, datetime.now() + timedelta(minutes=ACCESS_TOKEN_DELTA_MINUTES))
+        _entries[token] = entry
+        _tokens_by_email[user.email] = token
+        _pending[user.email] = (token, entry.expires)
+
+        while len(_entries) > TOKEN_CACHE_MAX_ENTRIES:
+            _drop(next(iter(_entries)))
+
+# Forgets every cached token of a user. Called whenever their token, password, permissions or account change
+def invalidate_user(email: str):
+    with _lock:
+        token = _tokens_by_email.get(email)
+        if token is not None:
+            _drop(token)
+        _pending.pop(email, None)
+
+# Writes the pending expiry extensions to the tokens table in a single transaction
+def flush(db: Session):
+    global _last_flush
+    with _lock:
+        pending = _pending.copy()
+        _pending.clear()
+        _last_flush = monotonic()
+
+    if not pending:
+        return
+    # A plain executemany UPDATE, which skips tokens deleted in the meantime, e.g. by the reaper, rather than
+    # failing the whole batch the way an ORM bulk update does when a row is missing
+    db.execute(
+        update(models.Token)
+        .where(models.Token.token == bindparam("oldToken"), models.Token.type == tokenType.ACCOUNT)
+        .values(expires=bindparam("newExpires")),
+        [{"oldToken": token, "newExpires": expires} for token, expires in pending.values()]
+    )
+    db.commit()
+
+def flush_if_due(db: Session):
+    if monotonic() - _last_flush >= TOKEN_FLUSH_INTERVAL_SECONDS:
+        flush(db)
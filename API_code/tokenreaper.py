@@ -0,0 +1,89 @@
+import asyncio
+import threading
+from datetime import datetime
+from time import monotonic
+
+from fastapi.concurrency import run_in_threadpool
+
+import crud
+import tokencache
+from database import SessionLocal
+
+# Periodically deletes expired rows from the tokens table, which nothing else removes once a user
+# stops logging in or never uses an emailed token. Runs as an asyncio task started with the API,
+# sweeping once at startup and then every interval_seconds. Each sweep deletes batches of at most
+# batch_size rows, one transaction each, until a batch comes back short, so a large backlog never
+# holds locks on the table for long. Every API process runs its own reaper, which is harmless as
+# deletes of rows that are already gone do nothing.
+
+
+class TokenReaper(object):
+    def __init__(self, interval_seconds: float = 300, batch_size: int = 500):
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+
+        self._task = None
+        self._lock = threading.Lock()
+        self._counters = {"sweeps": 0, "batches": 0, "reclaimed": 0, "errors": 0}
+        self._last_sweep = None
+        self._last_sweep_seconds = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics["lastSweep"] = self._last_sweep
+            metrics["lastSweepSeconds"] = self._last_sweep_seconds
+        metrics["running"] = self._task is not None and not self._task.done()
+        return metrics
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    # Deletes every expired token and returns how many were deleted. Blocking, so the task runs it in the threadpool
+    def sweep(self):
+        started = monotonic()
+        reclaimed = 0
+        db = SessionLocal()
+        try:
+            # Expiry extensions held by the token cache are written first, so no token in use looks expired
+            tokencache.flush(db)
+            while True:
+                deleted = crud.delete_expired_tokens(db, self.batch_size)
+                self._count("batches")
+                self._count("reclaimed", deleted)
+                reclaimed += deleted
+                if deleted < self.batch_size:
+                    break
+        finally:
+            db.close()
+
+        self._count("sweeps")
+        with self._lock:
+            self._last_sweep = datetime.now()
+            self._last_sweep_seconds = round(monotonic() - started, 3)
+        return reclaimed
+
+    async def _run(self):
+        while True:
+            try:
+                await run_in_threadpool(self.sweep)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The database may be briefly unavailable. Try again next interval rather than stopping for good
+                self._count("errors")
+            await asyncio.sleep(self.interval_seconds)